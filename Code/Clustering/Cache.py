@@ -0,0 +1,124 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+
+from Clustering.ClusterStore import (ClusterStore, DETECTORS, SHARED_COLUMNS,
+                                     DETECTOR_COLUMNS)
+from Clustering.Decoding import get_bin_file_paths
+from Clustering.Import import import_clusters
+from Clustering.Mapping import get_mapping_tables
+from Plotting.Profiling import profile_stage
+
+# =============================================================================
+# Cluster cache
+# =============================================================================
+
+# Clustered runs are stored as one .npy file per column, so that they can be
+# memory mapped when loaded
+CLUSTERS_FOLDER = os.path.join(os.path.dirname(__file__), '../../Clusters/')
+INFO_FILE = 'info.json'
+# Increase whenever decoding or the cache layout changes, so that caches
+# written by older versions are decoded again instead of reused
+CACHE_VERSION = 1
+
+
+def get_folder_id(folder_path):
+    folder_path = os.path.abspath(folder_path)
+    return hashlib.sha1(folder_path.encode('utf-8')).hexdigest()[:8]
+
+
+def get_cache_path(folder_path, file_paths, mapping_hash):
+    # Key on everything the clusters depend on: files and mapping tables
+    sha = hashlib.sha1()
+    sha.update(os.path.abspath(folder_path).encode('utf-8'))
+    for file_path in file_paths:
+        stat = os.stat(file_path)
+        sha.update(('%s %d %d' % (os.path.basename(file_path), stat.st_size,
+                                  stat.st_mtime_ns)).encode('utf-8'))
+    sha.update(mapping_hash.encode('utf-8'))
+    sha.update(('version %d' % CACHE_VERSION).encode('utf-8'))
+    name = '%s_%s' % (get_folder_id(folder_path), sha.hexdigest()[:16])
+    return os.path.join(CLUSTERS_FOLDER, name)
+
+
+def get_column_paths(cache_path):
+    column_paths = {('Shared', name): 'Shared_%s.npy' % name
+                    for name in SHARED_COLUMNS}
+    for detector in DETECTORS:
+        column_paths.update({(detector, name): '%s_%s.npy' % (detector, name)
+                             for name in DETECTOR_COLUMNS})
+    return {key: os.path.join(cache_path, file_name)
+            for key, file_name in column_paths.items()}
+
+
+def save_clusters(store, cache_path, folder_path):
+    # Write into a temporary folder, which is only renamed once complete
+    temporary_path = cache_path + '_tmp'
+    shutil.rmtree(temporary_path, ignore_errors=True)
+    os.makedirs(temporary_path)
+    for (group, name), path in get_column_paths(temporary_path).items():
+        np.save(path, store.column(group, name))
+    info = {'version': CACHE_VERSION, 'folder': os.path.abspath(folder_path),
+            'clusters': len(store), 'files': store.files}
+    with open(os.path.join(temporary_path, INFO_FILE), 'w') as info_file:
+        json.dump(info, info_file)
+    # Remove outdated caches of the same folder, next to the new cache
+    cache_folder = os.path.dirname(os.path.abspath(cache_path))
+    prefix = os.path.basename(cache_path).split('_')[0] + '_'
+    for name in os.listdir(cache_folder):
+        if name.startswith(prefix) and not name.endswith('_tmp'):
+            shutil.rmtree(os.path.join(cache_folder, name),
+                          ignore_errors=True)
+    os.replace(temporary_path, cache_path)
+
+
+def load_clusters(cache_path):
+    """Memory maps a cached run, returns None if there is no complete cache"""
+    column_paths = get_column_paths(cache_path)
+    info_path = os.path.join(cache_path, INFO_FILE)
+    if not all([os.path.exists(path) for path in column_paths.values()]):
+        return None
+    if not os.path.exists(info_path):
+        return None
+    with open(info_path, 'r') as info_file:
+        info = json.load(info_file)
+    if info.get('version') != CACHE_VERSION or 'files' not in info:
+        return None
+    shared = {}
+    detectors = {detector: {} for detector in DETECTORS}
+    for (group, name), path in column_paths.items():
+        values = np.load(path, mmap_mode='r')
+        if group == 'Shared':
+            shared[name] = values
+        else:
+            detectors[group][name] = values
+    return ClusterStore(shared, detectors, files=info['files'])
+
+
+def get_clusters(folder_path, workers=None, use_cache=True, progress=None,
+                 cancel=None):
+    """Clusters of all files in folder, loaded from the cache when possible.
+
+    Returns the store and the import timings of each file, which are empty
+    if the clusters were loaded from the cache. See import_clusters for
+    'progress' and 'cancel'.
+    """
+    mapping_tables = get_mapping_tables()
+    file_paths = get_bin_file_paths(folder_path)
+    cache_path = get_cache_path(folder_path, file_paths,
+                                mapping_tables['hash'])
+    if use_cache:
+        with profile_stage('Load cache'):
+            store = load_clusters(cache_path)
+        if store is not None:
+            return store, []
+    with profile_stage('Decode'):
+        store, timings = import_clusters(file_paths, mapping_tables['LUT'],
+                                         workers, progress=progress,
+                                         cancel=cancel)
+    if use_cache:
+        with profile_stage('Save cache'):
+            save_clusters(store, cache_path, folder_path)
+    return store, timings
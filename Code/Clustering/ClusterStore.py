@@ -0,0 +1,175 @@
+import numpy as np
+import pandas as pd
+
+# =============================================================================
+# Columns
+# =============================================================================
+
+DETECTORS = ['16_layers', '20_layers']
+# Detector geometry: wire layers, with four wires each, and grids
+LAYERS = {'16_layers': 16, '20_layers': 20}
+WIRES = {detector: 4 * layers for detector, layers in LAYERS.items()}
+GRIDS = 12
+# Column order of the per-detector cluster DataFrames
+COLUMNS = ['wADC_m1', 'wADC_m2', 'wChADC_m1', 'wChADC_m2', 'wCh_m1',
+           'gADC_m1', 'gADC_m2', 'gChADC_m1', 'gChADC_m2', 'gCh_m1', 'gCh_m2',
+           'gADC_max', 'gCh_max', 'ToF', 'Module', 'Valid']
+# Grids and time stamps are read out once for both detectors, only the wires
+# and the grid channel mapping differ between them. 'gADC_max' and 'gCh_max'
+# belong to the grid with the highest collected charge. 'Module' and 'Valid'
+# are decoded from the header word, 'Valid' is False for records without a
+# header signature.
+SHARED_COLUMNS = ['gADC_m1', 'gADC_m2', 'gChADC_m1', 'gChADC_m2', 'gADC_max',
+                  'ToF', 'Module', 'Valid']
+DETECTOR_COLUMNS = ['wADC_m1', 'wADC_m2', 'wChADC_m1', 'wChADC_m2', 'wCh_m1',
+                    'gCh_m1', 'gCh_m2', 'gCh_max']
+# Compact column types: 14-bit ADCs, channels (-1 if unmapped), 30-bit ToF,
+# 8-bit modules
+COLUMN_DTYPES = {'wADC_m1': np.uint16, 'wADC_m2': np.uint16,
+                 'wChADC_m1': np.uint16, 'wChADC_m2': np.uint16,
+                 'wCh_m1': np.int8,
+                 'gADC_m1': np.uint16, 'gADC_m2': np.uint16,
+                 'gChADC_m1': np.uint16, 'gChADC_m2': np.uint16,
+                 'gCh_m1': np.int8, 'gCh_m2': np.int8,
+                 'gADC_max': np.uint16, 'gCh_max': np.int8,
+                 'ToF': np.uint32, 'Module': np.uint8, 'Valid': np.bool_}
+# Capacity of grown columns relative to the current capacity
+GROWTH_FACTOR = 1.25
+
+
+# =============================================================================
+# Cluster store
+# =============================================================================
+
+class ClusterStore:
+    """Clusters of both detectors, with grid and ToF columns stored once.
+
+    Per-detector DataFrames are returned by 'view', these reference the
+    stored arrays instead of copying them. The arrays may be longer than the
+    number of clusters, leaving room for clusters appended during a live
+    measurement. 'files' holds the number of records clustered per file.
+    """
+
+    def __init__(self, shared, detectors, size=None, files=None):
+        self.shared = shared
+        self.detectors = detectors
+        self.size = len(shared['ToF']) if size is None else size
+        self.files = {} if files is None else files
+
+    @classmethod
+    def allocate(cls, size):
+        shared = {name: np.zeros([size], dtype=COLUMN_DTYPES[name])
+                  for name in SHARED_COLUMNS}
+        detectors = {detector: {name: np.zeros([size],
+                                               dtype=COLUMN_DTYPES[name])
+                                for name in DETECTOR_COLUMNS}
+                     for detector in DETECTORS}
+        return cls(shared, detectors)
+
+    def __len__(self):
+        return self.size
+
+    def capacity(self):
+        return len(self.shared['ToF'])
+
+    def arrays(self):
+        groups = [('Shared', self.shared)]
+        groups.extend([(detector, self.detectors[detector])
+                       for detector in DETECTORS])
+        return [(group, name, values)
+                for group, columns in groups
+                for name, values in columns.items()]
+
+    def insert(self, batch, start):
+        """Copies a decoded batch into the store, starting at row 'start'"""
+        length = len(batch['Shared']['ToF'])
+        for name, values in batch['Shared'].items():
+            self.shared[name][start:(start+length)] = values
+        for detector in DETECTORS:
+            for name, values in batch[detector].items():
+                self.detectors[detector][name][start:(start+length)] = values
+        return length
+
+    def reserve(self, capacity):
+        """Makes room for 'capacity' clusters in writable arrays in RAM.
+
+        Growing copies all columns into new arrays. For a store loaded from
+        the cache this means a one-time copy of the memory mapped columns
+        into RAM on the first append, with GROWTH_FACTOR of headroom. Later
+        appends only copy once the headroom is used up, so they stay
+        amortized O(batch).
+        """
+        if capacity <= self.capacity():
+            return
+        capacity = max(capacity, int(GROWTH_FACTOR * self.capacity()))
+        for group, name, values in self.arrays():
+            grown = np.zeros([capacity], dtype=values.dtype)
+            grown[:self.size] = values[:self.size]
+            if group == 'Shared':
+                self.shared[name] = grown
+            else:
+                self.detectors[group][name] = grown
+
+    def append(self, batch):
+        length = len(batch['Shared']['ToF'])
+        self.reserve(self.size + length)
+        self.size += self.insert(batch, self.size)
+        return length
+
+    def column(self, group, name):
+        if group == 'Shared':
+            return self.shared[name][:self.size]
+        else:
+            return self.detectors[group][name][:self.size]
+
+    def columns(self, detector):
+        columns = {name: self.column('Shared', name) for name in SHARED_COLUMNS}
+        columns.update({name: self.column(detector, name)
+                        for name in DETECTOR_COLUMNS})
+        return columns
+
+    def view(self, detector):
+        return pd.DataFrame(self.columns(detector), columns=COLUMNS,
+                            copy=False)
+
+    def batch(self):
+        """All clusters in the store, in the same layout as a decoded batch"""
+        batch = {'Shared': {name: self.column('Shared', name)
+                            for name in SHARED_COLUMNS}}
+        for detector in DETECTORS:
+            batch[detector] = {name: self.column(detector, name)
+                               for name in DETECTOR_COLUMNS}
+        return batch
+
+    def get_module_counts(self):
+        """Number of clusters of each module, {module: clusters}"""
+        counts = np.bincount(self.column('Shared', 'Module'))
+        return {int(module): int(counts[module])
+                for module in np.flatnonzero(counts)}
+
+    def get_invalid_count(self):
+        return int(len(self) - np.count_nonzero(self.column('Shared', 'Valid')))
+
+    def nbytes(self):
+        return sum([values.nbytes for group, name, values in self.arrays()])
+
+    def get_memory_report(self):
+        """Summary of the memory used by the shared and detector columns"""
+        total = self.nbytes()
+        lines = ['Clusters: %d, %.1f MB (%.1f bytes/cluster)'
+                 % (len(self), total / 1e6, total / max(len(self), 1))]
+        previous_group = None
+        for group, name, values in self.arrays():
+            if group != previous_group:
+                lines.append('  %s' % group)
+                previous_group = group
+            lines.append('    %-10s %-7s %10.1f MB' % (name, values.dtype,
+                                                       values.nbytes / 1e6))
+        return '\n'.join(lines)
+
+
+def get_batch_view(batch, detector):
+    """DataFrame of one detector's clusters in a decoded batch"""
+    columns = dict(batch['Shared'])
+    columns.update(batch[detector])
+    return pd.DataFrame(columns, columns=COLUMNS, copy=False)
@@ -0,0 +1,124 @@
+import os
+import numpy as np
+
+from Clustering.ClusterStore import DETECTORS
+
+# =============================================================================
+# Masks
+# =============================================================================
+
+SignatureMask    = 0xC0000000    # 1100 0000 0000 0000 0000 0000 0000 0000
+ModuleMask       = 0x00FF0000    # 0000 0000 1111 1111 0000 0000 0000 0000
+TimeStampMask    = 0x3FFFFFFF    # 0011 1111 1111 1111 1111 1111 1111 1111
+ADCMask          = 0x00003FFF    # 0000 0000 0000 0000 0011 1111 1111 1111
+
+Header           = 0x40000000    # 0100 0000 0000 0000 0000 0000 0000 0000
+ModuleShift      = 16
+
+# =============================================================================
+# Record layout
+# =============================================================================
+
+# Every cluster is stored as a record of 14 consecutive little-endian 32-bit
+# words: header, 12 ADC words and a time stamp
+WORDS_PER_RECORD = 14
+BYTES_PER_RECORD = 4 * WORDS_PER_RECORD
+RECORD_DTYPE = np.dtype([('Header', '<u4'),
+                         ('wADC_m1_16', '<u4'),
+                         ('wADC_m2_16', '<u4'),
+                         ('gADC_m1', '<u4'),
+                         ('gADC_m2', '<u4'),
+                         ('wChADC_m1_16', '<u4'),
+                         ('wChADC_m2_16', '<u4'),
+                         ('gChADC_m1', '<u4'),
+                         ('gChADC_m2', '<u4'),
+                         ('wADC_m1_20', '<u4'),
+                         ('wADC_m2_20', '<u4'),
+                         ('wChADC_m1_20', '<u4'),
+                         ('wChADC_m2_20', '<u4'),
+                         ('ToF', '<u4')])
+# Number of records decoded at a time (~56 MB of raw data per chunk)
+CHUNK_RECORDS = 1000000
+# Record field of each cluster column
+WIRE_FIELDS = {'16_layers': {'wADC_m1': 'wADC_m1_16', 'wADC_m2': 'wADC_m2_16',
+                             'wChADC_m1': 'wChADC_m1_16',
+                             'wChADC_m2': 'wChADC_m2_16'},
+               '20_layers': {'wADC_m1': 'wADC_m1_20', 'wADC_m2': 'wADC_m2_20',
+                             'wChADC_m1': 'wChADC_m1_20',
+                             'wChADC_m2': 'wChADC_m2_20'}}
+GRID_FIELDS = ['gADC_m1', 'gADC_m2', 'gChADC_m1', 'gChADC_m2']
+
+
+# =============================================================================
+# Files
+# =============================================================================
+
+def get_bin_file_paths(folder_path):
+    file_names = sorted([f for f in os.listdir(folder_path) if f[-4:] == '.bin'])
+    return [os.path.join(folder_path, file_name) for file_name in file_names]
+
+
+def get_measurement_time(folder_path):
+    # Time between the first and last file was written [s]
+    file_paths = get_bin_file_paths(folder_path)
+    start = os.path.getmtime(file_paths[0])
+    stop = os.path.getmtime(file_paths[-1])
+    return (stop - start)
+
+
+def get_number_of_records(file_paths):
+    # Incomplete records at the end of a file are ignored
+    return sum([os.path.getsize(file_path) // BYTES_PER_RECORD
+                for file_path in file_paths])
+
+
+def get_record_map(file_path):
+    """Memory maps a .bin file as a structured array of records (no copy)"""
+    number_records = os.path.getsize(file_path) // BYTES_PER_RECORD
+    if number_records == 0:
+        return np.zeros([0], dtype=RECORD_DTYPE)
+    return np.memmap(file_path, dtype=RECORD_DTYPE, mode='r',
+                     shape=(number_records,))
+
+
+def get_record_chunks(record_map, start=0, chunk_records=CHUNK_RECORDS):
+    """Yields (offset, records) for the records from 'start' on, as views"""
+    for offset in range(start, len(record_map), chunk_records):
+        yield offset, record_map[offset:(offset+chunk_records)]
+
+
+# =============================================================================
+# Decoding
+# =============================================================================
+
+def decode_chunk(records, ADC_to_Ch_LUT):
+    """Masks and channel maps a chunk of records into a cluster batch"""
+    def mask(values, bit_mask, dtype):
+        return (values & bit_mask).astype(dtype)
+
+    # Mask grid ADC words and time stamps, these are common to both detectors
+    shared = {field: mask(records[field], ADCMask, np.uint16)
+              for field in GRID_FIELDS}
+    shared['ToF'] = mask(records['ToF'], TimeStampMask, np.uint32)
+    # Header word: module of the record and whether it has a header signature
+    header = records['Header']
+    shared['Module'] = ((header & ModuleMask) >> ModuleShift).astype(np.uint8)
+    shared['Valid'] = (header & SignatureMask) == Header
+    # Select grid with highest collected charge, the second grid on ties
+    grid_1_max = shared['gADC_m1'] > shared['gADC_m2']
+    shared['gADC_max'] = np.where(grid_1_max, shared['gADC_m1'],
+                                  shared['gADC_m2'])
+    batch = {'Shared': shared}
+    # Perform wire masking and channel mapping for each detector
+    for detector in DETECTORS:
+        grid_LUT = ADC_to_Ch_LUT[detector]['Grids']
+        wire_LUT = ADC_to_Ch_LUT[detector]['Wires']
+        clusters = {name: mask(records[field], ADCMask, np.uint16)
+                    for name, field in WIRE_FIELDS[detector].items()}
+        clusters['wCh_m1'] = wire_LUT[clusters['wChADC_m1']]
+        clusters['gCh_m1'] = grid_LUT[shared['gChADC_m1']]
+        clusters['gCh_m2'] = grid_LUT[shared['gChADC_m2']]
+        clusters['gCh_max'] = np.where(grid_1_max, clusters['gCh_m1'],
+                                       clusters['gCh_m2'])
+        batch[detector] = clusters
+    return batch
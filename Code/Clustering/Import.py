@@ -0,0 +1,130 @@
+import os
+import time
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from Clustering.ClusterStore import ClusterStore
+from Clustering.Decoding import (decode_chunk, get_record_map,
+                                 get_record_chunks, get_number_of_records,
+                                 get_bin_file_paths, CHUNK_RECORDS)
+
+# =============================================================================
+# Parallel import
+# =============================================================================
+
+
+class ImportCancelled(Exception):
+    """Raised when an import is cancelled before all files are decoded"""
+
+
+def cluster_file(file_path, store, start, ADC_to_Ch_LUT,
+                 chunk_records=CHUNK_RECORDS, on_chunk=None, cancel=None):
+    """Decodes one file into the store rows beginning at 'start'.
+
+    'on_chunk' is called with the number of records of each decoded chunk,
+    and the import stops between chunks once the 'cancel' event is set.
+    """
+    start_time = time.time()
+    record_map = get_record_map(file_path)
+    invalid = 0
+    for offset, records in get_record_chunks(record_map, 0, chunk_records):
+        if cancel is not None and cancel.is_set():
+            raise ImportCancelled()
+        batch = decode_chunk(records, ADC_to_Ch_LUT)
+        store.insert(batch, start + offset)
+        invalid += len(records) - np.count_nonzero(batch['Shared']['Valid'])
+        if on_chunk is not None:
+            on_chunk(len(records))
+    return {'file': os.path.basename(file_path),
+            'records': len(record_map),
+            'invalid': invalid,
+            'time': time.time() - start_time}
+
+
+def import_clusters(file_paths, ADC_to_Ch_LUT, workers=None,
+                    chunk_records=CHUNK_RECORDS, progress=None, cancel=None):
+    """Clusters all files in parallel, returns the store and file timings.
+
+    Each file is assigned its own slice of the preallocated store, so
+    workers never write to the same rows. Threads are used since the
+    masking and lookups release the GIL and share the store directly.
+
+    'progress' is called after each chunk with (files done, files, records
+    done, records). Setting the 'cancel' event raises ImportCancelled.
+    """
+    # Get where in the store the clusters of each file begin
+    sizes = [get_number_of_records([file_path]) for file_path in file_paths]
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1])).astype(int)
+    store = ClusterStore.allocate(sum(sizes))
+    # Progress is shared by all workers
+    lock = threading.Lock()
+    done = {'files': 0, 'records': 0}
+
+    def on_chunk(records):
+        with lock:
+            done['records'] += records
+            if progress is not None:
+                progress(done['files'], len(file_paths), done['records'],
+                         sum(sizes))
+
+    def cluster_and_count(file_path, start):
+        timing = cluster_file(file_path, store, start, ADC_to_Ch_LUT,
+                              chunk_records, on_chunk, cancel)
+        with lock:
+            done['files'] += 1
+            if progress is not None:
+                progress(done['files'], len(file_paths), done['records'],
+                         sum(sizes))
+        return timing
+
+    # Fan files out to the pool
+    if workers is None:
+        workers = min(len(file_paths), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        futures = [executor.submit(cluster_and_count, file_path, start)
+                   for file_path, start in zip(file_paths, starts)]
+        timings = [future.result() for future in futures]
+    store.files = {timing['file']: timing['records'] for timing in timings}
+    return store, timings
+
+
+# =============================================================================
+# Incremental import
+# =============================================================================
+
+
+def update_clusters(store, folder_path, ADC_to_Ch_LUT, callback=None,
+                    chunk_records=CHUNK_RECORDS):
+    """Appends records that arrived since the store was last updated.
+
+    Only new files, and the new part of files that are still being written,
+    are decoded. Each decoded batch is also passed to 'callback', if given.
+    Returns the number of appended clusters.
+    """
+    new_records = 0
+    for file_path in get_bin_file_paths(folder_path):
+        file_name = os.path.basename(file_path)
+        record_map = get_record_map(file_path)
+        done = store.files.get(file_name, 0)
+        for _, records in get_record_chunks(record_map, done, chunk_records):
+            batch = decode_chunk(records, ADC_to_Ch_LUT)
+            new_records += store.append(batch)
+            if callback is not None:
+                callback(batch)
+        store.files[file_name] = max(done, len(record_map))
+    return new_records
+
+
+def get_timings_report(timings, total_time):
+    records = sum([timing['records'] for timing in timings])
+    lines = ['%s: %d records, %f [s]' % (timing['file'], timing['records'],
+                                         timing['time'])
+             for timing in timings]
+    invalid = sum([timing['invalid'] for timing in timings])
+    if invalid > 0:
+        lines.append('Records without header signature: %d' % invalid)
+    lines.append('Imported %d records from %d files in %f [s] (%.0f records/s)'
+                 % (records, len(timings), total_time,
+                    records / max(total_time, 1e-9)))
+    return '\n'.join(lines)
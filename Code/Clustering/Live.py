@@ -0,0 +1,90 @@
+import numpy as np
+
+from Clustering.ClusterStore import DETECTORS, WIRES, GRIDS, get_batch_view
+from Clustering.Decoding import ADCMask, TimeStampMask
+from Plotting.HelperFunctions import filter_clusters
+from Plotting.Histograms import histogram_1D
+
+# =============================================================================
+# Resolution of the running histograms
+# =============================================================================
+
+# PHS are kept at full ADC resolution and ToF in bins of 2^10 TDC channels,
+# both are rebinned to the requested number of bins when drawn
+ADC_BINS = ADCMask + 1
+TOF_SHIFT = 10
+TOF_BINS = (TimeStampMask >> TOF_SHIFT) + 1
+# Polling interval of the data folder in watch mode [ms]
+WATCH_INTERVAL = 2000
+
+
+# =============================================================================
+# Running histograms
+# =============================================================================
+
+class LiveHistograms:
+    """Running PHS, ToF and coincidence histograms of a live measurement.
+
+    Batches of new clusters are added as they are decoded, so the views can
+    be redrawn without histogramming the full event list again. Filters are
+    applied to each batch with the values set when the batch arrived.
+    """
+
+    def __init__(self):
+        self.PHS = {detector: {'Wires': np.zeros(ADC_BINS, dtype=np.int64),
+                               'Grids': np.zeros(ADC_BINS, dtype=np.int64)}
+                    for detector in DETECTORS}
+        self.ToF = np.zeros(TOF_BINS, dtype=np.int64)
+        self.coincidences = {detector: np.zeros((WIRES[detector], GRIDS),
+                                                dtype=np.int64)
+                             for detector in DETECTORS}
+        self.clusters = 0
+
+    def accumulate(self, clusters, detector):
+        """Adds the (filtered) clusters of one detector"""
+        # PHS
+        wADC = clusters['wADC_m1'].values
+        gADC = np.concatenate((clusters['gADC_m1'].values,
+                               clusters['gADC_m2'].values))
+        self.PHS[detector]['Wires'] += np.bincount(wADC, minlength=ADC_BINS)
+        self.PHS[detector]['Grids'] += np.bincount(gADC, minlength=ADC_BINS)
+        # Coincidences, using the grid with the highest collected charge
+        wires = WIRES[detector]
+        wCh = clusters['wCh_m1'].values
+        gCh = clusters['gCh_max'].values
+        valid = (wCh >= 0) & (wCh < wires) & (gCh >= 0) & (gCh < GRIDS)
+        index = wCh[valid].astype(np.int64) * GRIDS + gCh[valid]
+        counts = np.bincount(index, minlength=wires*GRIDS)
+        self.coincidences[detector] += counts.reshape(wires, GRIDS)
+
+    def accumulate_batch(self, batch, parameters):
+        """Adds a decoded cluster batch, filtered with the current cuts"""
+        # ToF is drawn without filters, as in the ToF histogram
+        self.ToF += np.bincount(batch['Shared']['ToF'] >> TOF_SHIFT,
+                                minlength=TOF_BINS)
+        for detector in DETECTORS:
+            clusters = filter_clusters(get_batch_view(batch, detector),
+                                       parameters, use_cache=False)
+            self.accumulate(clusters, detector)
+        self.clusters += len(batch['Shared']['ToF'])
+
+    def get_PHS(self, detector, wg, number_bins, limit=4095):
+        """PHS rebinned to 'number_bins' in [0, limit], as plt.hist does"""
+        return histogram_1D(np.arange(limit+1), number_bins, [0, limit],
+                            weights=self.PHS[detector][wg][:(limit+1)])
+
+    def get_ToF(self, number_bins):
+        """ToF rebinned to 'number_bins' over the range with counts"""
+        occupied = np.flatnonzero(self.ToF)
+        if len(occupied) == 0:
+            return histogram_1D([], number_bins)
+        start, stop = occupied[0], occupied[-1] + 1
+        return histogram_1D(np.arange(start, stop) << TOF_SHIFT, number_bins,
+                            [start << TOF_SHIFT, stop << TOF_SHIFT],
+                            weights=self.ToF[start:stop])
+
+    def get_coincidences(self, detector):
+        wires = WIRES[detector]
+        wire_edges = np.arange(wires+1) - 0.5
+        grid_edges = np.arange(GRIDS+1) - 0.5
+        return self.coincidences[detector], wire_edges, grid_edges
@@ -0,0 +1,186 @@
+import os
+import hashlib
+import tempfile
+import numpy as np
+import pandas as pd
+
+# Number of possible values of a 14-bit ADC
+ADC_RANGE = 0x4000
+# Excel tables and the compiled binary version of them
+TABLES_FOLDER = os.path.join(os.path.dirname(__file__), '../../Tables/')
+DELIMITERS_PATH = os.path.join(TABLES_FOLDER, 'Histogram_delimiters.xlsx')
+MAPPING_PATH = os.path.join(TABLES_FOLDER, 'Grid_Wire_Channel_Mapping.xlsx')
+CACHE_PATH = os.path.join(TABLES_FOLDER, 'Mapping_cache.npz')
+# Mapping tables already loaded in this session, keyed on the tables' hash
+mapping_tables_memo = {}
+
+# =============================================================================
+# Delimiter table
+# =============================================================================
+
+def read_delimiter_table():
+    # Import excel files
+    matrix = pd.read_excel(DELIMITERS_PATH).values
+    # Save delimiters for 16 and 20 layers in dictionary
+    indices = [[0, 1, 2, 3], [4, 5, 6, 7]]
+    detectors = ['20_layers', '16_layers']
+    delimiters_dictionary = {'20_layers': None, '16_layers': None}
+    for detector, (a, b, c, d) in zip(detectors, indices):
+        wires, grids = [], []
+        #print(detector)
+        for row in matrix[1:]:
+            if not np.isnan(row[a]):
+                wires.append(np.array([row[a], row[b]]))  # 0 1
+            if not np.isnan(row[c]):  # 2
+                grids.append(np.array([row[c], row[d]]))  # 2 3
+        delimiters_dictionary[detector] = {
+                        'Wires': np.array(wires, dtype=float).reshape(-1, 2),
+                        'Grids': np.array(grids, dtype=float).reshape(-1, 2)}
+        #print(delimiters_dictionary[detector])
+    return delimiters_dictionary
+
+def read_channel_mappings():
+    # Import excel files
+    matrix = pd.read_excel(MAPPING_PATH).values
+    # Save channel mappings for 16 and 20 layers in dictionary
+    indices = [[1, 3], [5, 7]]
+    detectors = ['20_layers', '16_layers']
+    channel_mapping_table = {'20_layers': None, '16_layers': None}
+    for detector, (a, b), layers in zip(detectors, indices, [20, 16]):
+        wires, grids = {}, {}
+        #print(detector)
+        for row in matrix[1:]:
+            if not np.isnan(row[a]):
+                if layers == 16:
+                    row_start = (row[a-1]//layers)*layers
+                    value = (3*layers - row_start) + (row[a-1] - row_start)  # row[a-1]  #
+                else:
+                    value = row[a-1]
+                wires.update({row[a]: value })
+            if not np.isnan(row[b]):
+                grids.update({row[b]: row[b-1]})
+        channel_mapping_table[detector] = {'Wires': wires,
+                                           'Grids': grids}
+        #print(channel_mapping_table[detector])
+    return channel_mapping_table
+
+
+def compile_ADC_to_Ch_LUT(delimiters_dictionary, channel_mapping_dictionary):
+    # Declare parameters
+    detectors = ['20_layers', '16_layers']
+    layers_dict = {'Wires': 16, 'Grids': 12}
+    ADC_to_Ch_LUT = {'20_layers': None, '16_layers': None}
+    for detector in detectors:
+        # Get values for current detector
+        delimiters_table = delimiters_dictionary[detector]
+        channel_mapping = channel_mapping_dictionary[detector]
+        # Prepare lookup tables covering all 14-bit ADC values, -1 if unmapped
+        ADC_to_Ch = {'Wires': np.full(ADC_RANGE, -1, dtype=np.int8),
+                     'Grids': np.full(ADC_RANGE, -1, dtype=np.int8)}
+        for key, delimiters in delimiters_table.items():
+            layers = layers_dict[key]
+            for i, (start, stop) in enumerate(delimiters):
+                # Get channel mapping and delimiters
+                small_delimiters = np.linspace(start, stop, layers+1)
+                edges = np.round(small_delimiters).astype(int)
+                # Assign ADC->Ch mapping for all values within each interval
+                for j, (start, stop) in enumerate(zip(edges[:-1], edges[1:])):
+                    channel = channel_mapping[key][i*layers+j]
+                    ADC_to_Ch[key][start:stop] = channel
+        ADC_to_Ch_LUT[detector] = ADC_to_Ch
+    return ADC_to_Ch_LUT
+
+
+# =============================================================================
+# Mapping cache
+# =============================================================================
+
+def get_tables_hash():
+    # Hash of the content of both excel files
+    sha = hashlib.sha1()
+    for path in [DELIMITERS_PATH, MAPPING_PATH]:
+        with open(path, 'rb') as table_file:
+            sha.update(table_file.read())
+    return sha.hexdigest()
+
+
+def save_mapping_cache(mapping_tables):
+    arrays = {'hash': np.array(mapping_tables['hash'])}
+    for table in ['delimiters', 'LUT']:
+        for detector, tables in mapping_tables[table].items():
+            for key, values in tables.items():
+                arrays['%s/%s/%s' % (table, detector, key)] = values
+    # Write to a temporary file of our own first, so that a crash, or other
+    # processes compiling the tables at the same time, never leave a
+    # half-written cache behind
+    handle, temporary_path = tempfile.mkstemp(prefix='Mapping_cache_',
+                                              suffix='.npz', dir=TABLES_FOLDER)
+    try:
+        with os.fdopen(handle, 'wb') as temporary_file:
+            np.savez(temporary_file, **arrays)
+        os.replace(temporary_path, CACHE_PATH)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+
+
+def load_mapping_cache():
+    mapping_tables = {'hash': None,
+                      'delimiters': {'20_layers': {}, '16_layers': {}},
+                      'LUT': {'20_layers': {}, '16_layers': {}}}
+    with np.load(CACHE_PATH) as cache:
+        for name in cache.files:
+            if name == 'hash':
+                mapping_tables['hash'] = str(cache['hash'])
+            else:
+                table, detector, key = name.split('/')
+                mapping_tables[table][detector][key] = cache[name]
+    return mapping_tables
+
+
+def get_mapping_tables():
+    """Delimiters and ADC->Ch lookup tables, compiled from the excel files.
+
+    The compiled tables are cached in 'Tables/Mapping_cache.npz' together
+    with the hash of the excel files, and recompiled when these change.
+    """
+    tables_hash = get_tables_hash()
+    if tables_hash in mapping_tables_memo:
+        return mapping_tables_memo[tables_hash]
+    mapping_tables = None
+    if os.path.exists(CACHE_PATH):
+        # A corrupt or truncated cache, e.g. a BadZipFile, is recompiled
+        try:
+            mapping_tables = load_mapping_cache()
+        except Exception:
+            mapping_tables = None
+    if mapping_tables is None or mapping_tables['hash'] != tables_hash:
+        delimiters_dictionary = read_delimiter_table()
+        channel_mapping_dictionary = read_channel_mappings()
+        ADC_to_Ch_LUT = compile_ADC_to_Ch_LUT(delimiters_dictionary,
+                                              channel_mapping_dictionary)
+        mapping_tables = {'hash': tables_hash,
+                          'delimiters': delimiters_dictionary,
+                          'LUT': ADC_to_Ch_LUT}
+        save_mapping_cache(mapping_tables)
+    mapping_tables_memo.clear()
+    mapping_tables_memo[tables_hash] = mapping_tables
+    return mapping_tables
+
+
+def import_delimiter_table():
+    return get_mapping_tables()['delimiters']
+
+
+def get_ADC_to_Ch_LUT():
+    return get_mapping_tables()['LUT']
+
+
+def get_ADC_to_Ch_dict():
+    # Dictionary version of the lookup tables, for ADC values 0 to 4095
+    ADC_to_Ch_LUT = get_ADC_to_Ch_LUT()
+    ADC_to_Ch_dict = {}
+    for detector, tables in ADC_to_Ch_LUT.items():
+        ADC_to_Ch_dict[detector] = {key: dict(enumerate(LUT[:4096].tolist()))
+                                    for key, LUT in tables.items()}
+    return ADC_to_Ch_dict
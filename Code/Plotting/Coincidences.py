@@ -1,83 +1,70 @@
 import matplotlib.pyplot as plt
 from matplotlib.colors import LogNorm
-import plotly as py
 import numpy as np
-import plotly.graph_objs as go
 import pandas as pd
-import plotly.io as pio
 import os
-from Plotting.HelperFunctions import filter_clusters
+import base64
+from Plotting.HelperFunctions import filter_clusters, get_live_figure
+from Plotting.Histograms import histogram_2D, plot_histogram_2D
+from Clustering.ClusterStore import LAYERS, GRIDS
+
+# Layout of the detectors in the 3D view, offsets (x, y, z) in [mm]
+DETECTOR_OFFSETS = {'20_layers': (100, 0, 0), '16_layers': (0, 0, 40)}
 
 # =============================================================================
 # Coincidence Histogram (2D)
 # =============================================================================
 
 
-def Coincidences_2D_plot(window):
-    # Declare parameters (added with condition if empty array)
-    data_sets = window.data_sets.splitlines()[0]
-    df_20 = window.Clusters_20_layers
-    df_16 = window.Clusters_16_layers
-    # Intial filter
-    clusters_20 = filter_clusters(df_20, window)
-    clusters_16 = filter_clusters(df_16, window)
-    #print(clusters_20)
-    clusters_vec = [clusters_20, clusters_16]
-    clusters_dict = {'ce_20': {'w': None, 'g': None},
-                     'ce_16': {'w': None, 'g': None}}
-    # Select grids with highest collected charge
-    for clusters, name in zip(clusters_vec, ['ce_20', 'ce_16']):
-        #print('gADC_m1')
-        #print(clusters['gADC_m1'])
-        #print('gADC_m2')
-        #print(clusters['gADC_m2'])
-        #print('gCh_m1')
-        #print(clusters['gCh_m1'])
-        #print('gCh_2')
-        #print(clusters['gCh_m2'])
-        #print('wADC_m1')
-        #print(clusters['wADC_m1'])
-        #print('wCh_m1')
-        #print(clusters['gCh_m1'])
-        channels_g1 = clusters[clusters['gADC_m1'] > clusters['gADC_m2']]['gCh_m1']
-        channels_w1 = clusters[clusters['gADC_m1'] > clusters['gADC_m2']]['wCh_m1']
-        channels_g2 = clusters[clusters['gADC_m1'] <= clusters['gADC_m2']]['gCh_m2']
-        channels_w2 = clusters[clusters['gADC_m1'] <= clusters['gADC_m2']]['wCh_m1']
-        clusters_dict[name]['g'] = channels_g1.append(channels_g2)
-        clusters_dict[name]['w'] = channels_w1.append(channels_w2)
-
-    fig = plt.figure()
-    plt.subplot(1, 2, 1)
-    plt.title('16 layers')
+def Coincidences_2D_plot(parameters, live=None):
+    def plot_bus(histogram, vmin, vmax):
+        counts, wire_edges, grid_edges = histogram
+        plot_histogram_2D(counts, wire_edges, grid_edges, vmin, vmax)
+        plt.xlabel('Wires')
+        plt.ylabel('Grids')
+        plt.colorbar()
 
-    hist_all = plt.hist2d(clusters_dict['ce_16']['w'],
-                          clusters_dict['ce_16']['g'],
-                          bins=[64, 12],
-                          range=[[-0.5, 63.5], [-0.5, 11.5]],
-                          norm=LogNorm(), cmap='jet')
-    hist = hist_all[0]
-    els = []
-    for row in hist:
-        for i in row:
-            els.append(i)
-    max_16 = max(els)
-    min_16 = min(els)
+    # Declare parameters (added with condition if empty array)
+    data_sets = parameters.data_sets.splitlines()[0]
+    if live is None:
+        df_20 = parameters.Clusters_20_layers
+        df_16 = parameters.Clusters_16_layers
+        # Intial filter
+        clusters_20 = filter_clusters(df_20, parameters)
+        clusters_16 = filter_clusters(df_16, parameters)
+        clusters_vec = [clusters_20, clusters_16]
+        clusters_dict = {'ce_20': {'w': None, 'g': None},
+                         'ce_16': {'w': None, 'g': None}}
+        # Select grids with highest collected charge
+        for clusters, name in zip(clusters_vec, ['ce_20', 'ce_16']):
+            clusters_dict[name]['g'] = clusters['gCh_max'].values
+            clusters_dict[name]['w'] = clusters['wCh_m1'].values
+        histogram_16 = histogram_2D(clusters_dict['ce_16']['w'],
+                                    clusters_dict['ce_16']['g'],
+                                    [64, 12], [[-0.5, 63.5], [-0.5, 11.5]])
+        histogram_20 = histogram_2D(clusters_dict['ce_20']['w'],
+                                    clusters_dict['ce_20']['g'],
+                                    [80, 12], [[-0.5, 79.5], [-0.5, 11.5]])
+        fig = plt.figure()
+        title = 'Coincident events (2D) -- Data set(s): %s' % data_sets
+    else:
+        histogram_16 = live.get_coincidences('16_layers')
+        histogram_20 = live.get_coincidences('20_layers')
+        fig = get_live_figure('Live coincidences (2D)')
+        title = ('Coincident events (2D), live: %d clusters -- Data set(s): %s'
+                 % (live.clusters, data_sets))
+    max_16 = max(histogram_16[0].max(), 1)
+    min_16 = histogram_16[0].min()
     if min_16 == 0:
         min_16 = 1
-    plt.xlabel('Wires')
-    plt.ylabel('Grids')
-    plt.colorbar()
+    plt.subplot(1, 2, 1)
+    plt.title('16 layers')
+    plot_bus(histogram_16, None, None)
     plt.subplot(1, 2, 2)
     plt.title('20 layers')
-    plt.hist2d(clusters_dict['ce_20']['w'], clusters_dict['ce_20']['g'],
-               bins=[80, 12],
-               range=[[-0.5, 79.5], [-0.5, 11.5]],
-               norm=LogNorm(), cmap='jet', vmin=min_16, vmax=max_16)
+    plot_bus(histogram_20, min_16, max_16)
     print("Using color axis from 16-layers plot also for 20-layers plot")
-    plt.xlabel('Wires')
-    plt.ylabel('Grids')
-    fig.suptitle('Coincident events (2D) -- Data set(s): %s' % data_sets)
-    plt.colorbar()
+    fig.suptitle(title)
     plt.tight_layout()
 
     return fig
@@ -87,118 +74,30 @@ def Coincidences_2D_plot(window):
 # Coincidence Histogram (3D)
 # =============================================================================
 
-def Coincidences_3D_plot(window):
+def Coincidences_3D_plot(parameters, min_count=0, max_count=np.inf,
+                         lightweight=True):
+    df_20 = parameters.Clusters_20_layers
+    df_16 = parameters.Clusters_16_layers
     # Intial filter
-    #df = filter_clusters(df, window)
-    df_20 = window.Clusters_20_layers
-    df_16 = window.Clusters_16_layers
-    #print(df_20[['wCh_m1', 'gCh_m1']])
-    # Intial filter
-    clusters_20 = filter_clusters(df_20, window)
-    clusters_16 = filter_clusters(df_16, window)
+    clusters_20 = filter_clusters(df_20, parameters)
+    clusters_16 = filter_clusters(df_16, parameters)
     clusters_vec = [clusters_20, clusters_16]
-    clusters_dict = {'ce_20': {'w': None, 'g': None},
-                     'ce_16': {'w': None, 'g': None}}
-    # Select grids with highest collected charge
-    for clusters, name in zip(clusters_vec, ['ce_20', 'ce_16']):
-        channels_g1 = clusters[clusters['gADC_m1'] > clusters['gADC_m2']]['gCh_m1']
-        channels_w1 = clusters[clusters['gADC_m1'] > clusters['gADC_m2']]['wCh_m1']
-        channels_g2 = clusters[clusters['gADC_m1'] <= clusters['gADC_m2']]['gCh_m2']
-        channels_w2 = clusters[clusters['gADC_m1'] <= clusters['gADC_m2']]['wCh_m1']
-        clusters_dict[name]['g'] = channels_g1.append(channels_g2)
-        clusters_dict[name]['w'] = channels_w1.append(channels_w2)
-
-    # Declare max and min count
-    min_count = 0
-    max_count = np.inf
-    # Initiate 'voxel_id -> (x, y, z)'-mapping
-    MG24_ch_to_coord_20, MG24_ch_to_coord_16 = get_MG24_to_XYZ_mapping(window)
-    #print(MG24_ch_to_coord_16)
-
-    #print("20 wires", clusters_dict['ce_20']['w'].values)
-    #print("20 grids", clusters_dict['ce_20']['g'].values)
-    ##wires = clusters_dict['ce_20']['w']
-    #print(np.array([clusters_dict['ce_20']['w'].values,
-    #                clusters_dict['ce_20']['g'].values]))
-
-    # Calculate 3D histogram
-    H_20, edges_20 = np.histogramdd((clusters_dict['ce_20']['w'].values,
-                                     clusters_dict['ce_20']['g'].values),
-                              bins=(80, 13),
-                              range=((0, 80), (0, 13)))
-
-    # Insert results into an array
-    hist_20 = [[], [], [], []]
-    loc_20 = 0
-    labels_20 = []
-    for wCh in range(0, 80):
-        for gCh in range(0, 13):
-            over_min = H_20[wCh, gCh] > min_count
-            under_max = H_20[wCh, gCh] <= max_count
-            if over_min and under_max:
-                coord = MG24_ch_to_coord_20[gCh, wCh]
-                hist_20[0].append(coord['x'])
-                hist_20[1].append(coord['y'])
-                hist_20[2].append(coord['z'])
-                hist_20[3].append(H_20[wCh, gCh])
-                loc_20 += 1
-                labels_20.append('Wire Channel: ' + str(wCh) + '<br>'
-                              + 'Grid Channel: ' + str(gCh) + '<br>'
-                              + 'Counts: ' + str(H_20[wCh, gCh])
-                              )
-    # for 16 layers
-    H_16, edges_16 = np.histogramdd((clusters_dict['ce_16']['w'].values,
-                                     clusters_dict['ce_16']['g'].values),
-                              bins=(64, 13),
-                              range=((0, 64), (0, 13))
-                              )
-
-    # Insert results into an array
-    hist_16 = [[], [], [], []]
-    loc_16 = 0
-    labels_16 = []
-    for wCh in range(0, 64):
-        for gCh in range(0, 13):
-            over_min = H_16[wCh, gCh] > min_count
-            under_max = H_16[wCh, gCh] <= max_count
-            if over_min and under_max:
-                coord = MG24_ch_to_coord_16[gCh, wCh]
-                hist_16[0].append(coord['x'])
-                hist_16[1].append(coord['y'])
-                hist_16[2].append(coord['z'])
-                hist_16[3].append(H_16[wCh, gCh])
-                loc_16 += 1
-                labels_16.append('Wire Channel: ' + str(wCh) + '<br>'
-                              + 'Grid Channel: ' + str(gCh) + '<br>'
-                              + 'Counts: ' + str(H_16[wCh, gCh])
-                              )
-
-    #print("hist20", hist_20[3])
-    #print("hist16", hist_16[3])
-
-
-    labels = []
-    labels.extend(labels_20)
-    labels.extend(labels_16)
-
-    # Produce 3D histogram plot
+    # Voxels with counts within (min_count, max_count] of both detectors
     hist = [[], [], [], []]
-    hist_x_offset = [i + 100 for i in hist_20[0]]
-    hist_z_offset = [i +  40 for i in hist_16[2]]
-    hist[0].extend(hist_x_offset)
-    hist[0].extend(hist_16[0])
-    hist[1].extend(hist_20[1])
-    hist[1].extend(hist_16[1])
-    hist[2].extend(hist_20[2])
-    hist[2].extend(hist_z_offset)
-    hist[3].extend(hist_20[3])
-    hist[3].extend(hist_16[3])
-
-    #print(hist_20[0])
-    #print("hist0", hist[0])
-    #print("hist1", hist[1])
-    #print("hist2", hist[2])
-    #print("hist3", hist[3])
+    labels = []
+    for clusters, detector in zip(clusters_vec, ['20_layers', '16_layers']):
+        x, y, z, counts, voxel_labels = get_voxels(clusters, detector,
+                                                   min_count, max_count)
+        for values, voxel_values in zip(hist, [x, y, z, counts]):
+            values.append(voxel_values)
+        labels.append(voxel_labels)
+    hist = [np.concatenate(values) for values in hist]
+    labels = np.concatenate(labels)
+
+    # plotly is slow to import and only needed here
+    import plotly as py
+    import plotly.graph_objs as go
+    import plotly.io as pio
     MG_3D_trace = go.Scatter3d(x=hist[0],
                                y=hist[1],
                                z=hist[2],
@@ -225,12 +124,21 @@ def Coincidences_3D_plot(window):
     fig['layout']['scene1']['xaxis'].update(title='x [mm]')
     fig['layout']['scene1']['yaxis'].update(title='y [mm]')
     fig['layout']['scene1']['zaxis'].update(title='z [mm]')
-    fig['layout'].update(title='Coincidences (3D) - ' + window.data_sets)
+    fig['layout'].update(title='Coincidences (3D) - ' + parameters.data_sets)
     fig.layout.showlegend = False
-    # If in plot He3-tubes histogram, return traces, else save HTML and plot
-    py.offline.plot(fig,
-                    filename='../Results/Coincidences_3D/Ce3Dhistogram.html',
-                    auto_open=True)
+    output_path = os.path.join(os.path.dirname(__file__),
+                               '../../Results/Coincidences_3D/Ce3Dhistogram.html')
+    if lightweight:
+        # Voxels as binary typed arrays, plotly.js is copied next to the HTML
+        # on the first call and then only referenced
+        fig = fig.to_dict()
+        for axis, values in zip(['x', 'y', 'z'], hist[:3]):
+            fig['data'][0][axis] = get_typed_array(values, '<f4')
+        fig['data'][0]['marker']['color'] = get_typed_array(hist[3], '<u4')
+        pio.write_html(fig, output_path, include_plotlyjs='directory',
+                       validate=False, auto_open=True)
+    else:
+        py.offline.plot(fig, filename=output_path, auto_open=True)
     #pio.write_image(fig, '../Results/HTML_files/Ce3Dhistogram.pdf')
 
 
@@ -238,47 +146,44 @@ def Coincidences_3D_plot(window):
 # Coincidence Histogram (Front, Top, Side)
 # =============================================================================
 
-def Coincidences_Front_Top_Side_plot(window):
+def Coincidences_Front_Top_Side_plot(parameters):
     def plot_front(wires, grids, layers, vmin, vmax):
-        plt.hist2d(wires // layers, grids, bins=[4, 12],
-                   range=[[-0.5, 3.5], [-0.5, 11.5]], norm=LogNorm(),
-                   cmap='jet', vmin=vmin, vmax=vmax)
+        plot_histogram_2D(*histogram_2D(wires // layers, grids, [4, 12],
+                                        [[-0.5, 3.5], [-0.5, 11.5]]),
+                          vmin=vmin, vmax=vmax)
         plt.title('Front view (%d layers)' % layers)
         plt.xlabel('Row')
         plt.ylabel('Grid')
         plt.colorbar()
     def plot_top(wires, grids, layers, vmin, vmax):
-        plt.hist2d(wires // layers, wires % layers, bins=[4, layers],
-                   range=[[-0.5, 3.5], [-0.5, layers-0.5]], norm=LogNorm(),
-                   cmap='jet', vmin=vmin, vmax=vmax)
+        plot_histogram_2D(*histogram_2D(wires // layers, wires % layers,
+                                        [4, layers],
+                                        [[-0.5, 3.5], [-0.5, layers-0.5]]),
+                          vmin=vmin, vmax=vmax)
         plt.title('Top view (%d layers)' % layers)
         plt.xlabel('Row')
         plt.ylabel('Layer')
         plt.colorbar()
     def plot_side(wires, grids, layers, vmin, vmax):
-        plt.hist2d(wires % layers, grids, bins=[layers, 12],
-                   range=[[-0.5, layers-0.5], [-0.5, 11.5]], norm=LogNorm(),
-                   cmap='jet', vmin=vmin, vmax=vmax)
+        plot_histogram_2D(*histogram_2D(wires % layers, grids, [layers, 12],
+                                        [[-0.5, layers-0.5], [-0.5, 11.5]]),
+                          vmin=vmin, vmax=vmax)
         plt.title('Side view (%d layers)' % layers)
         plt.xlabel('Layer')
         plt.ylabel('Grid')
         plt.colorbar()
 
     # Declare parameters (added with condition if empty array)
-    data_sets = window.data_sets.splitlines()[0]
-    df_20 = window.Clusters_20_layers
-    df_16 = window.Clusters_16_layers
+    data_sets = parameters.data_sets.splitlines()[0]
+    df_20 = parameters.Clusters_20_layers
+    df_16 = parameters.Clusters_16_layers
     clusters_vec = [df_20, df_16]
     clusters_dict = {'ce_20': {'w': None, 'g': None},
                      'ce_16': {'w': None, 'g': None}}
     # Select grids with highest collected charge
     for clusters, name in zip(clusters_vec, ['ce_20', 'ce_16']):
-        channels_g1 = clusters[clusters['gADC_m1'] > clusters['gADC_m2']]['gCh_m1']
-        channels_w1 = clusters[clusters['gADC_m1'] > clusters['gADC_m2']]['wCh_m1']
-        channels_g2 = clusters[clusters['gADC_m1'] <= clusters['gADC_m2']]['gCh_m2']
-        channels_w2 = clusters[clusters['gADC_m1'] <= clusters['gADC_m2']]['wCh_m1']
-        clusters_dict[name]['g'] = channels_g1.append(channels_g2)
-        clusters_dict[name]['w'] = channels_w1.append(channels_w2)
+        clusters_dict[name]['g'] = clusters['gCh_max']
+        clusters_dict[name]['w'] = clusters['wCh_m1']
     wires_20 = clusters_dict['ce_20']['w'].values
     grids_20 = clusters_dict['ce_20']['g'].values
     wires_16 = clusters_dict['ce_16']['w'].values
@@ -349,25 +254,42 @@ def plot_2D_Side(bus_vec, df, fig, number_of_detectors, vmin, vmax):
 # Helper Functions
 # =============================================================================
 
-def get_MG24_to_XYZ_mapping(window):
-    # Declare voxelspacing in [mm]
-    WireSpacing = 10
-    LayerSpacing = 23.5
-    GridSpacing = 23.5
-    # Iterate over all channels and create mapping
-    MG24_ch_to_coord_20 = np.empty((12, 80), dtype='object')
-    for gCh in np.arange(0, 12, 1):
-        for wCh in np.arange(0, 80, 1):
-            x = (wCh // 20) * LayerSpacing
-            y = gCh * GridSpacing
-            z = (wCh % 20) * WireSpacing
-            MG24_ch_to_coord_20[gCh, wCh] = {'x': x, 'y': y, 'z': z}
-    #elif whichgrid == "layers_16":
-    MG24_ch_to_coord_16 = np.empty((12, 64), dtype='object')
-    for gCh in np.arange(0, 12, 1):
-        for wCh in np.arange(0, 64, 1):
-            x = (wCh // 16) * LayerSpacing
-            y = gCh * GridSpacing
-            z = (wCh % 16) * WireSpacing
-            MG24_ch_to_coord_16[gCh, wCh] = {'x': x, 'y': y, 'z': z}
-    return MG24_ch_to_coord_20, MG24_ch_to_coord_16
+def get_MG24_to_XYZ_mapping(layers, offset=(0, 0, 0), WireSpacing=10,
+                            LayerSpacing=23.5, GridSpacing=23.5):
+    """Voxel coordinates in [mm] as float32 arrays x, y, z[wCh, gCh]"""
+    wCh = np.arange(layers*4)[:, np.newaxis]
+    gCh = np.arange(GRIDS)[np.newaxis, :]
+    shape = (layers*4, GRIDS)
+    x = np.broadcast_to((wCh // layers) * LayerSpacing + offset[0], shape)
+    y = np.broadcast_to(gCh * GridSpacing + offset[1], shape)
+    z = np.broadcast_to((wCh % layers) * WireSpacing + offset[2], shape)
+    return x.astype(np.float32), y.astype(np.float32), z.astype(np.float32)
+
+
+def get_typed_array(values, dtype):
+    """Array as a plotly.js typed array, i.e. base64 of its binary values"""
+    data = np.ascontiguousarray(values, dtype=dtype).tobytes()
+    return {'dtype': np.dtype(dtype).str[1:],
+            'bdata': base64.b64encode(data).decode('ascii')}
+
+
+def get_voxels(clusters, detector, min_count=0, max_count=np.inf):
+    """Coordinates, counts and hover labels of voxels within the count range.
+
+    Grid channels are taken as the grid with the highest collected charge.
+    """
+    layers = LAYERS[detector]
+    counts, *_ = histogram_2D(clusters['wCh_m1'].values,
+                              clusters['gCh_max'].values,
+                              [layers*4, GRIDS],
+                              [[-0.5, layers*4-0.5], [-0.5, GRIDS-0.5]])
+    coords = get_MG24_to_XYZ_mapping(layers, DETECTOR_OFFSETS[detector])
+    selection = (counts > min_count) & (counts <= max_count)
+    wCh, gCh = np.nonzero(selection)
+    counts = counts[selection]
+    labels = np.char.add(np.char.add(np.char.add(
+        'Wire Channel: ', wCh.astype(str)),
+        np.char.add('<br>Grid Channel: ', gCh.astype(str))),
+        np.char.add('<br>Counts: ', counts.astype(str)))
+    x, y, z = [coord[selection] for coord in coords]
+    return x, y, z, counts, labels
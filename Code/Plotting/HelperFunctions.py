@@ -1,13 +1,50 @@
-import os
-import numpy as np
-import pandas as pd
+import weakref
+from collections import OrderedDict
+import matplotlib.pyplot as plt
+
+from Plotting.Profiling import profile_stage
+
+# Maximum memory held by cached filter results [bytes]
+FILTER_CACHE_BYTES = 2 * 1024 ** 3
 
 # =============================================================================
 # Filter
 # =============================================================================
 
 
-def filter_clusters(clusters, window):
+class AnalysisParameters:
+    """Clusters, cuts and binning of an analysis, without any GUI objects.
+
+    'filters' maps each column to [min, max, filter_on], as returned by
+    get_filter_parameters. The plotting functions only read from this
+    object, so they can be run both from the GUI and headless.
+    """
+
+    def __init__(self, Clusters_16_layers, Clusters_20_layers, data_sets='',
+                 filters=None, phsBins=50, tofBins=500, chBins=2000,
+                 measurement_time=0):
+        self.Clusters_16_layers = Clusters_16_layers
+        self.Clusters_20_layers = Clusters_20_layers
+        self.data_sets = data_sets
+        self.filters = {} if filters is None else filters
+        self.phsBins = phsBins
+        self.tofBins = tofBins
+        self.chBins = chBins
+        self.measurement_time = measurement_time
+
+
+def get_parameters(window):
+    # Snapshot of the current values in the GUI
+    return AnalysisParameters(window.Clusters_16_layers,
+                              window.Clusters_20_layers,
+                              data_sets=window.data_sets,
+                              filters=get_filter_parameters(window),
+                              phsBins=int(window.phsBins.text()),
+                              tofBins=int(window.tofBins.text()),
+                              chBins=int(window.chBins.text()))
+
+
+def get_filter_parameters(window):
     # Declare parameters
     parameters = {'wADC_m1': [window.wADC_min.value(),
                               window.wADC_max.value(),
@@ -33,100 +70,111 @@ def filter_clusters(clusters, window):
                   'gCh_m2': [window.gCh_min.value(),
                              window.gCh_max.value(),
                              window.gCh_filter.isChecked()],
+                  'Module': [window.module_min.value(),
+                             window.module_max.value(),
+                             window.module_filter.isChecked()],
                   }
-    # Only include the filters that we want to use
-    ce_red = clusters
+    return parameters
+
+
+def get_filter_mask(clusters, parameters):
+    """Combined mask of all active cuts, None if no cut is active.
+
+    All cuts are and-ed in place into a single boolean array, so no
+    intermediate DataFrames are created.
+    """
+    mask = None
     for par, (min_val, max_val, filter_on) in parameters.items():
         if filter_on:
-            ce_red = ce_red[(ce_red[par] >= min_val) & (ce_red[par] <= max_val)]
-    return ce_red
+            values = clusters[par].values
+            if mask is None:
+                mask = values >= min_val
+            else:
+                mask &= values >= min_val
+            mask &= values <= max_val
+    return mask
+
+
+class FilterCache:
+    """Least recently used filter results, bounded by their memory.
+
+    Results are keyed on the dataset and the active cuts. The dataset is
+    identified by the clusters object itself, which is only weakly
+    referenced: the cache never keeps a dataset alive, and the results of a
+    dataset are dropped when it is deleted, before its id can be reused.
+    """
+
+    def __init__(self, max_bytes=FILTER_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+
+    def get_key(self, clusters, parameters):
+        cuts = tuple([(par, min_val, max_val)
+                      for par, (min_val, max_val, filter_on)
+                      in parameters.items() if filter_on])
+        return (id(clusters), cuts)
+
+    def get(self, clusters, parameters):
+        key = self.get_key(clusters, parameters)
+        entry = self.entries.get(key)
+        if entry is None or entry[0]() is not clusters:
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, clusters, parameters, result):
+        key = self.get_key(clusters, parameters)
+        nbytes = int(result.memory_usage(index=True).sum())
+        if nbytes > self.max_bytes:
+            return
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key)[2]
+        self.entries[key] = (weakref.ref(clusters, self.get_release(key[0])),
+                             result, nbytes)
+        self.nbytes += nbytes
+        # Evict least recently used results until within the memory limit
+        while self.nbytes > self.max_bytes:
+            self.nbytes -= self.entries.popitem(last=False)[1][2]
+
+    def get_release(self, dataset):
+        # Callback dropping all results of a dataset once it is deleted
+        def release(reference):
+            for key in [key for key in self.entries if key[0] == dataset]:
+                self.nbytes -= self.entries.pop(key)[2]
+        return release
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+
+filter_cache = FilterCache()
+
+
+def filter_clusters(clusters, analysis_parameters, use_cache=True):
+    # Only include the clusters which pass all active filters
+    parameters = analysis_parameters.filters
+    with profile_stage('Filter'):
+        if use_cache:
+            ce_red = filter_cache.get(clusters, parameters)
+            if ce_red is not None:
+                return ce_red
+        mask = get_filter_mask(clusters, parameters)
+        if mask is None:
+            return clusters
+        ce_red = clusters[mask]
+        if use_cache:
+            filter_cache.put(clusters, parameters, ce_red)
+        return ce_red
 
 
 # =============================================================================
-# Delimiter table
+# Live figures
 # =============================================================================
 
-def import_delimiter_table():
-    # Import excel files
-    dirname = os.path.dirname(__file__)
-    path = os.path.join(dirname, '../../Tables/Histogram_delimiters.xlsx')
-    matrix = pd.read_excel(path).values
-    # Save delimiters for 16 and 20 layers in dictionary
-    indices = [[0, 1, 2, 3], [4, 5, 6, 7]]
-    detectors = ['20_layers', '16_layers']
-    delimiters_dictionary = {'20_layers': None, '16_layers': None}
-    for detector, (a, b, c, d) in zip(detectors, indices):
-        wires, grids = [], []
-        #print(detector)
-        for row in matrix[1:]:
-            if not np.isnan(row[a]):
-                wires.append(np.array([row[a], row[b]]))  # 0 1
-            if not np.isnan(row[c]):  # 2
-                grids.append(np.array([row[c], row[d]]))  # 2 3
-        delimiters_dictionary[detector] = {'Wires': np.array(wires),
-                                           'Grids': np.array(grids)}
-        #print(delimiters_dictionary[detector])
-    return delimiters_dictionary
-
-def import_channel_mappings():
-    # Import excel files
-    dirname = os.path.dirname(__file__)
-    path = os.path.join(dirname, '../../Tables/Grid_Wire_Channel_Mapping.xlsx')
-    matrix = pd.read_excel(path).values
-    # Save channel mappings for 16 and 20 layers in dictionary
-    indices = [[1, 3], [5, 7]]
-    detectors = ['20_layers', '16_layers']
-    channel_mapping_table = {'20_layers': None, '16_layers': None}
-    for detector, (a, b), layers in zip(detectors, indices, [20, 16]):
-        wires, grids = {}, {}
-        #print(detector)
-        for row in matrix[1:]:
-            if not np.isnan(row[a]):
-                if layers == 16:
-                    row_start = (row[a-1]//layers)*layers
-                    value = (3*layers - row_start) + (row[a-1] - row_start)  # row[a-1]  #
-                else:
-                    value = row[a-1]
-                wires.update({row[a]: value })
-            if not np.isnan(row[b]):
-                grids.update({row[b]: row[b-1]})
-        channel_mapping_table[detector] = {'Wires': wires,
-                                           'Grids': grids}
-        #print(channel_mapping_table[detector])
-    return channel_mapping_table
-
-
-def get_ADC_to_Ch_dict():
-    # Declare parameters
-    detectors = ['20_layers', '16_layers']
-    layers_dict = {'Wires': 16, 'Grids': 12}
-    delimiters_dictionary = import_delimiter_table()
-    channel_mapping_dictionary = import_channel_mappings()
-    ADC_to_Ch_dict = {'20_layers': None, '16_layers': None}
-    for detector in detectors:
-        # Get values for current detector
-        delimiters_table = delimiters_dictionary[detector]
-        channel_mapping = channel_mapping_dictionary[detector]
-        # Prepare storage of mapping for current detector
-        ADC_to_Ch = {'Wires': {i: -1 for i in range(4096)},
-                     'Grids': {i: -1 for i in range(4096)}}
-        #print(detector)
-        #print('--')
-        for key, delimiters in delimiters_table.items():
-            layers = layers_dict[key]
-            for i, (start, stop) in enumerate(delimiters):
-                # Get channel mapping and delimiters
-                small_delimiters = np.linspace(start, stop, layers+1)
-                # Iterate through small delimiters
-                previous_value = small_delimiters[0]
-                for j, value in enumerate(small_delimiters[1:]):
-                    channel = channel_mapping[key][i*layers+j]
-                    #print('i: %s, Ch: %s' % (str(i*layers+j), str(channel)))
-                    start, stop = int(round(previous_value)), int(round(value))
-                    # Assign ADC->Ch mapping for all values within interval
-                    for k in np.arange(start, stop, 1):
-                        ADC_to_Ch[key][k] = channel
-                    previous_value = value
-            ADC_to_Ch_dict[detector] = ADC_to_Ch
-        #print(ADC_to_Ch_dict[detector])
-    return ADC_to_Ch_dict
+def get_live_figure(label):
+    # Live views are redrawn into the same figure window on every update
+    fig = plt.figure(label)
+    fig.clf()
+    return fig
@@ -0,0 +1,109 @@
+from collections import OrderedDict
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.colors import LogNorm
+
+from Plotting.Profiling import profile_stage
+
+# =============================================================================
+# Binning
+# =============================================================================
+
+# Bin lookup tables of small integer types, keyed on (dtype, edges). Only
+# the most recently used ones are kept, one table of a uint16 column is 512 kB
+bin_lookup_memo = OrderedDict()
+BIN_LOOKUPS_KEPT = 16
+
+
+def get_edges(number_bins, limits):
+    return np.linspace(limits[0], limits[1], number_bins+1)
+
+
+def get_limits(values):
+    # Same default range as np.histogram
+    if len(values) == 0:
+        return 0, 1
+    start, stop = values.min(), values.max()
+    if start == stop:
+        return start - 0.5, stop + 0.5
+    return start, stop
+
+
+def get_bin_lookup(dtype, edges):
+    key = (dtype.str, edges.tobytes())
+    if key in bin_lookup_memo:
+        bin_lookup_memo.move_to_end(key)
+    else:
+        info = np.iinfo(dtype)
+        all_values = np.arange(info.min, info.max+1)
+        bin_lookup_memo[key] = get_bin_indices(all_values, edges)
+        while len(bin_lookup_memo) > BIN_LOOKUPS_KEPT:
+            bin_lookup_memo.popitem(last=False)
+    return bin_lookup_memo[key]
+
+
+def get_bin_indices(values, edges):
+    """Bin index of each value, -1 outside the edges (as in np.histogram)"""
+    values = np.asarray(values)
+    number_bins = len(edges) - 1
+    if values.dtype.kind in 'ui' and values.dtype.itemsize <= 2:
+        # One lookup per value for ADCs and channels
+        lookup = get_bin_lookup(values.dtype, edges)
+        offset = np.iinfo(values.dtype).min
+        if offset == 0:
+            return lookup[values]
+        return lookup[values.astype(np.intp) - offset]
+    indices = np.searchsorted(edges, values, side='right') - 1
+    # Last bin includes its upper edge
+    indices[values == edges[-1]] = number_bins - 1
+    indices[indices >= number_bins] = -1
+    return indices
+
+
+# =============================================================================
+# Histograms
+# =============================================================================
+
+def histogram_1D(values, number_bins, limits=None, weights=None):
+    """Counts and edges of 'number_bins' equal bins within 'limits'"""
+    with profile_stage('Histogram'):
+        values = np.asarray(values)
+        if limits is None:
+            limits = get_limits(values)
+        edges = get_edges(number_bins, limits)
+        indices = get_bin_indices(values, edges)
+        inside = indices >= 0
+        if weights is not None:
+            weights = np.asarray(weights)[inside]
+        counts = np.bincount(indices[inside], weights=weights,
+                             minlength=number_bins)
+        return counts, edges
+
+
+def histogram_2D(x, y, bins, limits):
+    """Counts (x bins, y bins) and edges, from the packed index x*ny + y"""
+    with profile_stage('Histogram'):
+        x_edges = get_edges(bins[0], limits[0])
+        y_edges = get_edges(bins[1], limits[1])
+        x_indices = get_bin_indices(x, x_edges)
+        y_indices = get_bin_indices(y, y_edges)
+        inside = (x_indices >= 0) & (y_indices >= 0)
+        packed = (x_indices[inside].astype(np.int64) * bins[1]
+                  + y_indices[inside])
+        counts = np.bincount(packed, minlength=bins[0]*bins[1])
+        return counts.reshape(bins[0], bins[1]), x_edges, y_edges
+
+
+# =============================================================================
+# Drawing
+# =============================================================================
+
+def plot_histogram_1D(counts, edges, **kwargs):
+    return plt.stairs(counts, edges, **kwargs)
+
+
+def plot_histogram_2D(counts, x_edges, y_edges, vmin=None, vmax=None,
+                      cmap='jet'):
+    # Empty bins are left blank, as in plt.hist2d with a log scale
+    return plt.pcolormesh(x_edges, y_edges, np.ma.masked_equal(counts.T, 0),
+                          norm=LogNorm(vmin=vmin, vmax=vmax), cmap=cmap)
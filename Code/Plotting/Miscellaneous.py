@@ -1,12 +1,11 @@
 import matplotlib.pyplot as plt
 from matplotlib.colors import LogNorm
-import plotly as py
 import numpy as np
-import plotly.graph_objs as go
 import pandas as pd
-import plotly.io as pio
 import os
-from Plotting.HelperFunctions import import_delimiter_table, filter_clusters
+from Plotting.HelperFunctions import filter_clusters, get_live_figure
+from Clustering.Mapping import import_delimiter_table
+from Plotting.Histograms import histogram_1D, plot_histogram_1D
 
 
 # =============================================================================
@@ -14,16 +13,21 @@ from Plotting.HelperFunctions import import_delimiter_table, filter_clusters
 # =============================================================================
 
 
-def ToF_histogram(window):
+def ToF_histogram(parameters, live=None):
     # Get parameters
-    number_bins = int(window.tofBins.text())
+    number_bins = parameters.tofBins
     # Produce histogram and plot
-    fig = plt.figure()
-    plt.hist(window.Clusters_16_layers.ToF, bins=number_bins,
-             log=True, color='black', zorder=4,
-             histtype='step', label='MG'
-             )
-    plt.title('ToF - histogram\n%s' % window.data_sets)
+    if live is None:
+        fig = plt.figure()
+        counts, edges = histogram_1D(parameters.Clusters_16_layers.ToF.values,
+                                     number_bins)
+        plt.title('ToF - histogram\n%s' % parameters.data_sets)
+    else:
+        fig = get_live_figure('Live ToF')
+        counts, edges = live.get_ToF(number_bins)
+        plt.title('ToF - histogram, live: %d clusters\n%s' % (live.clusters,
+                                                              parameters.data_sets))
+    plot_histogram_1D(counts, edges, color='black', zorder=4, label='MG')
     plt.xlabel('ToF [TDC channels]')
     plt.ylabel('Counts')
     plt.grid(True, which='major', linestyle='--', zorder=0)
@@ -37,7 +41,7 @@ def ToF_histogram(window):
 # =============================================================================
 
 
-def Channels_plot(window):
+def Channels_plot(parameters):
     def channels_plot_bus(events, sub_title, number_bins, delimiters):
         # Plot
         plt.title(sub_title)
@@ -46,8 +50,8 @@ def Channels_plot(window):
         plt.grid(True, which='major', zorder=0)
         plt.grid(True, which='minor', linestyle='--', zorder=0)
         plt.yscale('log')
-        plt.hist(events, bins=number_bins, range=[0, 4100],
-                 histtype='step', color='black', zorder=5)
+        counts, edges = histogram_1D(events.values, number_bins, [0, 4100])
+        plot_histogram_1D(counts, edges, color='black', zorder=5)
         for delimiter in delimiters:
             plt.axvline(delimiter[0], color='red', zorder=5)
             plt.axvline(delimiter[1], color='red', zorder=5)
@@ -60,8 +64,8 @@ def Channels_plot(window):
                 plt.axvline(small_delimiter, color='blue', zorder=2)
 
     # Declare parameters
-    df_20 = window.Clusters_20_layers
-    df_16 = window.Clusters_16_layers
+    df_20 = parameters.Clusters_20_layers
+    df_16 = parameters.Clusters_16_layers
     attributes_20 = ['wChADC_m1', 'wChADC_m2']
     attributes_16 = ['wChADC_m1', 'wChADC_m2']
     attributes_grids = ['gChADC_m1', 'gChADC_m2']
@@ -69,13 +73,13 @@ def Channels_plot(window):
     cols = 2
     height = 12
     width = 10
-    number_bins = int(window.chBins.text())
+    number_bins = parameters.chBins
     delimiter_table = import_delimiter_table()
     # Prepare figure
     fig = plt.figure()
     fig.set_figheight(height)
     fig.set_figwidth(width)
-    title = 'Channels (1D)\n(%s, ...)' % window.data_sets.splitlines()[0]
+    title = 'Channels (1D)\n(%s, ...)' % parameters.data_sets.splitlines()[0]
     fig.suptitle(title, x=0.5, y=1.03)
     # Plot figure
     for i, attribute in enumerate(attributes_20):
@@ -116,7 +120,7 @@ def Channels_plot(window):
 # ============================================================================
 
 
-def ADC_plot(window):
+def ADC_plot(parameters):
     def PHS_1D_plot_bus(events, sub_title, number_bins):
         # Plot
         plt.title(sub_title)
@@ -125,8 +129,8 @@ def ADC_plot(window):
         plt.grid(True, which='major', zorder=0)
         plt.grid(True, which='minor', linestyle='--', zorder=0)
         plt.yscale('log')
-        plt.hist(events, bins=number_bins, range=[0, 4095],
-                 histtype='step', color='black', zorder=5)
+        counts, edges = histogram_1D(events.values, number_bins, [0, 4095])
+        plot_histogram_1D(counts, edges, color='black', zorder=5)
     # Declare parameters
     attributes = ['gADC_m1', 'gADC_m2',
                   'wADC_m1', 'wADC_m2',
@@ -136,27 +140,27 @@ def ADC_plot(window):
     cols = 4
     height = 12
     width = 10
-    number_bins = int(window.chBins.text())
+    number_bins = parameters.chBins
     # Prepare figure
     fig = plt.figure()
     fig.set_figheight(height)
     fig.set_figwidth(width)
-    title = 'PHS (1D)\n(%s, ...)' % window.data_sets.splitlines()[0]
+    title = 'PHS (1D)\n(%s, ...)' % parameters.data_sets.splitlines()[0]
     fig.suptitle(title, x=0.5, y=1.03)
     # Plot figure - 16 layers
     for i, attribute in enumerate(attributes):
-        events_attribute = window.Clusters_16_layers[attribute]
+        events_attribute = parameters.Clusters_16_layers[attribute]
         plt.subplot(rows, cols, i+1)
         sub_title = attribute + ' (16 layers)'
         PHS_1D_plot_bus(events_attribute, sub_title, number_bins)
     for i, attribute in enumerate(attributes):
-        events_attribute = window.Clusters_20_layers[attribute]
+        events_attribute = parameters.Clusters_20_layers[attribute]
         plt.subplot(rows, cols, i+1+8)
         sub_title = attribute + ' (20 layers)'
         PHS_1D_plot_bus(events_attribute, sub_title, number_bins)
     # Plot figure - 20 layers
     for i, attribute in enumerate(attributes):
-            events_attribute = window.Clusters_20_layers[attribute]
+            events_attribute = parameters.Clusters_20_layers[attribute]
             plt.subplot(rows, cols, i+1+8)
             sub_title = attribute + ' (20 layers)'
             PHS_1D_plot_bus(events_attribute, sub_title, number_bins)
@@ -167,91 +171,82 @@ def ADC_plot(window):
 # Channels rates plot
 # ============================================================================
 
-def Channels_rates_plot(window, measurement_time):
-    """plots neutron event rate for each channel"""
-    def channel_rates_plot_bus(events, subtitle, typeCh, name, wires):
-        plt.xlabel('grid channel')
+def get_channel_counts(channels, number_channels):
+    """Counts per channel 0, 1, ..., number_channels-1, unmapped are skipped"""
+    channels = np.asarray(channels)
+    valid = (channels >= 0) & (channels < number_channels)
+    return np.bincount(channels[valid], minlength=number_channels)
+
+
+def get_channel_rates(clusters_20, clusters_16, measurement_time):
+    """Rate and Poisson error of each wire and grid channel.
+
+    Grid channels are taken as the grid with the highest collected charge.
+    Returns a table with one row per detector and channel.
+    """
+    tables = []
+    for clusters, detector, wires in zip([clusters_20, clusters_16],
+                                         ['20_layers', '16_layers'],
+                                         [80, 64]):
+        for typeCh, column, number_channels in [('gCh', 'gCh_max', 12),
+                                                ('wCh', 'wCh_m1', wires)]:
+            counts = get_channel_counts(clusters[column].values,
+                                        number_channels)
+            tables.append(pd.DataFrame({'Detector': detector,
+                                        'Type': typeCh,
+                                        'Channel': np.arange(number_channels),
+                                        'Counts': counts,
+                                        'Rate': counts/measurement_time,
+                                        'Error': (np.sqrt(counts)
+                                                  / measurement_time)}))
+    return pd.concat(tables, ignore_index=True)
+
+
+def save_channel_rates(rates, file_name):
+    """Writes the channel rates table to Results/Rates/'file_name'"""
+    dir_name = os.path.dirname(__file__)
+    output_path = os.path.join(dir_name, '../../Results/Rates/', file_name)
+    rates.to_csv(output_path, index=False)
+    return output_path
+
+
+def Channels_rates_plot(parameters, measurement_time):
+    """plots neutron event rate for each channel, returns figure and rates"""
+    def channel_rates_plot_bus(rates, sub_title, typeCh, color):
+        plt.xlabel('%s channel' % ('grid' if typeCh == 'gCh' else 'wire'))
         plt.ylabel('Rate of total counts')
         plt.grid(True, which='major', zorder=0)
         plt.grid(True, which='minor', linestyle='--', zorder=0)
-        plt.title("Grid rates")
-        #print("Grid channel \t rate")
-        gChs = []
-        g_rates = []
-        if typeCh == 'gCh':
-            for gCh in np.arange(0, 12, 1):
-                counts = 0
-                vals = clusters_dict[name]['g'].values
-                for val in vals:
-                    if val == gCh:
-                        counts += 1
-                rate = counts/((measurement_time))
-                gChs.append(gCh)
-                g_rates.append(rate)
-                #print(gCh, "\t", rate, "Hz")
-            plt.scatter(gChs, g_rates, color="darkorange", zorder=2)
-            plt.title(sub_title)
-
-        #print("Wire channel \t rate")
-        wChs = []
-        w_rates = []
-        if typeCh == 'wCh':
-            for wCh in np.arange(0, wires, 1):
-                counts = 0
-                vals = clusters_dict[name]['w'].values
-                for val in vals:
-                    if val == wCh:
-                        counts += 1
-                rate = counts/((measurement_time))
-                wChs.append(wCh)
-                w_rates.append(rate)
-                #print(wCh, "\t", rate, "Hz")
-            plt.scatter(wChs, w_rates, color="crimson", zorder=2)
-            plt.title(sub_title)
+        plt.errorbar(rates['Channel'], rates['Rate'], yerr=rates['Error'],
+                     fmt='o', color=color, zorder=2)
+        plt.title(sub_title)
 
     # Import data
-    ce_20 = window.Clusters_20_layers
-    ce_16 = window.Clusters_16_layers
+    ce_20 = parameters.Clusters_20_layers
+    ce_16 = parameters.Clusters_16_layers
     # Filter
-    ce_red_20 = filter_clusters(ce_20, window)
-    ce_red_16 = filter_clusters(ce_16, window)
-    clusters_20 = ce_red_20#.shape[0]
-    clusters_16 = ce_red_16#.shape[0]
-    clusters_vec = [clusters_20, clusters_16]
-    clusters_dict = {'ce_20': {'w': None, 'g': None},
-                     'ce_16': {'w': None, 'g': None}}
-    # Select grids with highest collected charge
-    for clusters, name in zip(clusters_vec, ['ce_20', 'ce_16']):
-        channels_g1 = clusters[clusters['gADC_m1'] > clusters['gADC_m2']]['gCh_m1']
-        channels_w1 = clusters[clusters['gADC_m1'] > clusters['gADC_m2']]['wCh_m1']
-        channels_g2 = clusters[clusters['gADC_m1'] <= clusters['gADC_m2']]['gCh_m2']
-        channels_w2 = clusters[clusters['gADC_m1'] <= clusters['gADC_m2']]['wCh_m1']
-        clusters_dict[name]['g'] = channels_g1.append(channels_g2)
-        clusters_dict[name]['w'] = channels_w1.append(channels_w2)
+    clusters_20 = filter_clusters(ce_20, parameters)
+    clusters_16 = filter_clusters(ce_16, parameters)
+    # Count all channels at once per detector
+    rates = get_channel_rates(clusters_20, clusters_16, measurement_time)
 
     typeChs = ['gCh', 'wCh']
     grids_or_wires = {'wCh': 'Wires', 'gCh': 'Grids'}
+    colors = {'wCh': 'crimson', 'gCh': 'darkorange'}
     # plot
     fig = plt.figure()
     fig.set_figheight(5)
     fig.set_figwidth(10)
-    plt.suptitle('Total rate per channel \n%s' % window.data_sets.splitlines()[0])
-
-    # for 20 layers
-    for i, typeCh in enumerate(typeChs):
-        sub_title = "%s -- 20 layers" % grids_or_wires[typeCh]
-        wires = 80
-        name = 'ce_20'
-        plt.subplot(2,2,i+1)
-        channel_rates_plot_bus(clusters_20, sub_title, typeCh, name, wires)
-
-    # for 16 layers
-    for i, typeCh in enumerate(typeChs):
-        sub_title = "%s -- 16 layers" % grids_or_wires[typeCh]
-        name = 'ce_16'
-        plt.subplot(2,2,i+3)
-        wires = 64
-        channel_rates_plot_bus(clusters_16, sub_title, typeCh, name, wires)
+    plt.suptitle('Total rate per channel \n%s' % parameters.data_sets.splitlines()[0])
+    for j, (detector, layers) in enumerate([('20_layers', 20),
+                                            ('16_layers', 16)]):
+        for i, typeCh in enumerate(typeChs):
+            sub_title = "%s -- %d layers" % (grids_or_wires[typeCh], layers)
+            plt.subplot(2, 2, i+1+2*j)
+            selection = ((rates['Detector'] == detector)
+                         & (rates['Type'] == typeCh))
+            channel_rates_plot_bus(rates[selection], sub_title, typeCh,
+                                   colors[typeCh])
 
     plt.subplots_adjust(left=0.1, right=0.98, top=0.86, bottom=0.09, wspace=0.25, hspace=0.45)
-    return fig
+    return fig, rates
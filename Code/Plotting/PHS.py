@@ -3,7 +3,10 @@ import numpy as np
 import os
 import pandas as pd
 from matplotlib.colors import LogNorm
-from Plotting.HelperFunctions import filter_clusters
+from Plotting.HelperFunctions import filter_clusters, get_live_figure
+from matplotlib.backends.backend_pdf import PdfPages
+from Plotting.Histograms import (get_edges, histogram_1D, histogram_2D,
+                                 plot_histogram_1D, plot_histogram_2D)
 
 
 # ============================================================================
@@ -11,8 +14,8 @@ from Plotting.HelperFunctions import filter_clusters
 # ============================================================================
 
 
-def PHS_1D_plot(window):
-    def PHS_1D_plot_bus(clusters, typeCh, sub_title, number_bins):
+def PHS_1D_plot(parameters, live=None):
+    def PHS_1D_plot_bus(clusters, typeCh, sub_title, number_bins, detector):
         # Plot
         plt.title(sub_title)
         plt.xlabel('Collected charge [ADC channels]')
@@ -20,27 +23,41 @@ def PHS_1D_plot(window):
         plt.grid(True, which='major', zorder=0)
         plt.grid(True, which='minor', linestyle='--', zorder=0)
         plt.yscale('log')
-        if wg == 'g':
-            adcs = clusters['gADC_m1'].append(clusters['gADC_m2'])
+        if live is not None:
+            counts, edges = live.get_PHS(detector, grids_or_wires[wg],
+                                         number_bins)
+        elif wg == 'g':
+            counts, edges = histogram_1D(clusters['gADC_m1'].values,
+                                         number_bins, [0, 4095])
+            counts += histogram_1D(clusters['gADC_m2'].values,
+                                   number_bins, [0, 4095])[0]
         else:
-            adcs = clusters['wADC_m1']
-        plt.hist(adcs, bins=number_bins, range=[0, 4095], histtype='step',
-                 color='black', zorder=5)
+            counts, edges = histogram_1D(clusters['wADC_m1'].values,
+                                         number_bins, [0, 4095])
+        plot_histogram_1D(counts, edges, color='black', zorder=5)
     # Import data
-    df_20 = window.Clusters_20_layers
-    df_16 = window.Clusters_16_layers
-    # Intial filter
-    clusters_20 = filter_clusters(df_20, window)
-    clusters_16 = filter_clusters(df_16, window)
+    df_20 = parameters.Clusters_20_layers
+    df_16 = parameters.Clusters_16_layers
+    # Intial filter, running histograms are already filtered
+    if live is None:
+        clusters_20 = filter_clusters(df_20, parameters)
+        clusters_16 = filter_clusters(df_16, parameters)
+    else:
+        clusters_20, clusters_16 = None, None
 
     # Declare parameters
-    number_bins = int(window.phsBins.text())
+    number_bins = parameters.phsBins
     wg_list = ['w', 'g']
     grids_or_wires = {'w': 'Wires', 'g': 'Grids'}
 
     # Prepare figure
-    fig = plt.figure()
-    title = 'PHS (1D)\n(%s, ...)' % window.data_sets.splitlines()[0]
+    if live is None:
+        fig = plt.figure()
+        title = 'PHS (1D)\n(%s, ...)' % parameters.data_sets.splitlines()[0]
+    else:
+        fig = get_live_figure('Live PHS (1D)')
+        title = ('PHS (1D), live: %d clusters\n(%s, ...)'
+                 % (live.clusters, parameters.data_sets.splitlines()[0]))
     fig.suptitle(title, x=0.5, y=1.03)
     fig.set_figheight(4)
     fig.set_figwidth(10)
@@ -49,14 +66,14 @@ def PHS_1D_plot(window):
     for i, wg in enumerate(wg_list):
         plt.subplot(2, 2, i+1)
         sub_title = grids_or_wires[wg] + " -- 20 layers"
-        PHS_1D_plot_bus(clusters_20, wg, sub_title, number_bins)
+        PHS_1D_plot_bus(clusters_20, wg, sub_title, number_bins, '20_layers')
     plt.tight_layout()
 
     # Plot figure for 16 layers
     for i, wg in enumerate(wg_list):
         plt.subplot(2, 2, i+3)
         sub_title = grids_or_wires[wg] + " -- 16 layers"
-        PHS_1D_plot_bus(clusters_16, wg, sub_title, number_bins)
+        PHS_1D_plot_bus(clusters_16, wg, sub_title, number_bins, '16_layers')
     plt.tight_layout()
 
     return fig
@@ -66,30 +83,33 @@ def PHS_1D_plot(window):
 # =============================================================================
 
 
-def PHS_2D_plot(window):
+def PHS_2D_plot(parameters):
     def PHS_2D_plot_bus(clusters, wg, limit, bins, sub_title, vmin, vmax):
         plt.xlabel('Channel')
         plt.ylabel('Charge [ADC channels]')
         plt.title(sub_title)
         if wg == 'g':
-            channels = clusters['gCh_m1'].append(clusters['gCh_m2'])
-            adcs = clusters['gADC_m1'].append(clusters['gADC_m2'])
+            counts, x_edges, y_edges = histogram_2D(clusters['gCh_m1'].values,
+                                                    clusters['gADC_m1'].values,
+                                                    [bins, 120],
+                                                    [limit, [0, 4095]])
+            counts += histogram_2D(clusters['gCh_m2'].values,
+                                   clusters['gADC_m2'].values,
+                                   [bins, 120], [limit, [0, 4095]])[0]
         else:
-            channels = clusters['wCh_m1']
-            adcs = clusters['wADC_m1']
-        plt.hist2d(channels, adcs,
-                   bins=[bins, 120],
-                   range=[limit, [0, 4095]], norm=LogNorm(),
-                   #vmin=vmin, vmax=vmax,
-                   cmap='jet')
+            counts, x_edges, y_edges = histogram_2D(clusters['wCh_m1'].values,
+                                                    clusters['wADC_m1'].values,
+                                                    [bins, 120],
+                                                    [limit, [0, 4095]])
+        plot_histogram_2D(counts, x_edges, y_edges)
         plt.colorbar()
 
     # Import data
-    df_20 = window.Clusters_20_layers
-    df_16 = window.Clusters_16_layers
+    df_20 = parameters.Clusters_20_layers
+    df_16 = parameters.Clusters_16_layers
     # Intial filter
-    clusters_20 = filter_clusters(df_20, window)
-    clusters_16 = filter_clusters(df_16, window)
+    clusters_20 = filter_clusters(df_20, parameters)
+    clusters_16 = filter_clusters(df_16, parameters)
 
     # Declare parameters
     wg_list = ['w', 'g']
@@ -101,7 +121,7 @@ def PHS_2D_plot(window):
 
     # Prepare figure
     fig = plt.figure()
-    title = 'PHS (2D) - MG\n(%s, ...)' % window.data_sets.splitlines()[0]
+    title = 'PHS (2D) - MG\n(%s, ...)' % parameters.data_sets.splitlines()[0]
     fig.suptitle(title, x=0.5, y=1.03)
     vmin = 1
     vmax_16 = clusters_16.shape[0] // 1000 + 100
@@ -129,57 +149,65 @@ def PHS_2D_plot(window):
 # PHS (Individual Channels)
 # =============================================================================
 
-def PHS_Individual_plot(window):
+def get_individual_PHS(clusters, wg, channels, number_bins):
+    """PHS of all channels in one pass, as counts[channel, ADC bin]"""
+    limits = [[-0.5, channels-0.5], [0, 4095]]
+    if wg == 'g':
+        counts, _, edges = histogram_2D(clusters['gCh_m1'].values,
+                                        clusters['gADC_m1'].values,
+                                        [channels, number_bins], limits)
+        counts += histogram_2D(clusters['gCh_m2'].values,
+                               clusters['gADC_m2'].values,
+                               [channels, number_bins], limits)[0]
+    else:
+        counts, _, edges = histogram_2D(clusters['wCh_m1'].values,
+                                        clusters['wADC_m1'].values,
+                                        [channels, number_bins], limits)
+    return counts, edges
+
+
+def PHS_Individual_plot(parameters):
+    """Saves the PHS of each channel as one page of a PDF per detector"""
     # Import data
-    df_20 = window.Clusters_20_layers
-    df_16 = window.Clusters_16_layers
+    df_20 = parameters.Clusters_20_layers
+    df_16 = parameters.Clusters_16_layers
     # Intial filter
-    clusters_16 = filter_clusters(df_16, window)
-    clusters_20 = filter_clusters(df_20, window)
+    clusters_16 = filter_clusters(df_16, parameters)
+    clusters_20 = filter_clusters(df_20, parameters)
     # Declare parameters
     clusters_vec = [clusters_16, clusters_20]
     detectors = ['16_layers', '20_layers']
     layers_vec = [16, 20]
     dir_name = os.path.dirname(__file__)
     folder_path = os.path.join(dir_name, '../../Results/PHS/')
-    number_bins = int(window.phsBins.text())
+    number_bins = parameters.phsBins
+    grids_or_wires = {'w': 'Wires', 'g': 'Grids'}
+    # One figure is reused for all pages, only the counts are replaced
+    fig = plt.figure()
+    plt.grid(True, which='major', zorder=0)
+    plt.grid(True, which='minor', linestyle='--', zorder=0)
+    plt.xlabel('Collected charge [ADC channels]')
+    plt.ylabel('Counts')
+    # Room for the two-line title, the pages are saved without a tight bbox
+    fig.subplots_adjust(top=0.85)
+    stairs = plot_histogram_1D(np.zeros(number_bins),
+                               get_edges(number_bins, [0, 4095]),
+                               color='black', zorder=5)
     # Save all PHS
     for clusters, detector, layers in zip(clusters_vec, detectors, layers_vec):
-        # Save wires PHS
-        for wCh in np.arange(0, layers*4, 1):
-            print('%s, Wires: %d/%d' % (detector, wCh, layers*4-1))
-            # Get ADC values
-            adcs = clusters[clusters.wCh_m1 == wCh]['wADC_m1']
-            # Plot
-            fig = plt.figure()
-            plt.hist(adcs, bins=number_bins, range=[0, 4095], histtype='step',
-                     color='black', zorder=5)
-            plt.grid(True, which='major', zorder=0)
-            plt.grid(True, which='minor', linestyle='--', zorder=0)
-            plt.xlabel('Collected charge [ADC channels]')
-            plt.ylabel('Counts')
-            plt.title('PHS wires - Channel %d\nData set: %s' % (wCh, window.data_sets))
-            # Save
-            output_path = '%s/%s/Wires/Channel_%d.pdf' % (folder_path, detector, wCh)
-            fig.savefig(output_path, bbox_inches='tight')
-            plt.close()
-        # Save grids PHS
-        for gCh in np.arange(0, 12, 1):
-            print('%s, Grids: %d/11' % (detector, gCh))
-            # Get ADC values
-            adcs_1 = clusters[clusters.gCh_m1 == gCh]['gADC_m1']
-            adcs_2 = clusters[clusters.gCh_m2 == gCh]['gADC_m2']
-            adcs = adcs_1.append(adcs_2)
-            # Plot
-            fig = plt.figure()
-            plt.hist(adcs, bins=number_bins, range=[0, 4095], histtype='step',
-                     color='black', zorder=5)
-            plt.grid(True, which='major', zorder=0)
-            plt.grid(True, which='minor', linestyle='--', zorder=0)
-            plt.xlabel('Collected charge [ADC channels]')
-            plt.ylabel('Counts')
-            plt.title('PHS grids - Channel %d\nData set: %s' % (gCh, window.data_sets))
-            # Save
-            output_path = '%s/%s/Grids/Channel_%d.pdf' % (folder_path, detector, gCh)
-            fig.savefig(output_path, bbox_inches='tight')
-            plt.close()
+        for wg, channels in [('w', layers*4), ('g', 12)]:
+            print('%s, %s: %d channels' % (detector, grids_or_wires[wg],
+                                           channels))
+            counts, edges = get_individual_PHS(clusters, wg, channels,
+                                               number_bins)
+            output_path = '%s/%s/%s/Channels.pdf' % (folder_path, detector,
+                                                     grids_or_wires[wg])
+            with PdfPages(output_path) as pdf:
+                for Ch in range(channels):
+                    stairs.set_data(values=counts[Ch])
+                    plt.ylim(0, max(counts[Ch].max(), 1) * 1.05)
+                    plt.title('PHS %s - Channel %d\nData set: %s'
+                              % (grids_or_wires[wg].lower(), Ch,
+                                 parameters.data_sets))
+                    pdf.savefig(fig)
+    plt.close(fig)
@@ -0,0 +1,164 @@
+import os
+import io
+import json
+import time
+import pstats
+import threading
+import cProfile
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+
+# Session reports are saved here
+PROFILING_FOLDER = os.path.join(os.path.dirname(__file__),
+                                '../../Results/Profiling/')
+# Most recent stage records kept, older ones only count in the summary
+RECORDS_KEPT = 10000
+
+# =============================================================================
+# Session profile
+# =============================================================================
+
+
+class SessionProfile:
+    """Time and memory of the stages of every action in a session.
+
+    Stages are timed with the 'stage' context manager and may be nested,
+    e.g. 'Filter' inside 'PHS (1D)'. Peak memory is only recorded while
+    memory tracing is on, and only for stages on the GUI (main) thread:
+    tracemalloc peaks are process wide, so a peak also includes memory
+    allocated by a background import running at the same time. All calls
+    on the GUI thread are profiled with cProfile while profiling is on. Every stage path is summarised as it
+    ends, so memory stays bounded however long the session runs, and only
+    the last RECORDS_KEPT individual records are kept.
+    """
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.records = deque(maxlen=RECORDS_KEPT)
+        self.summary = {}
+        # Stages end on both the GUI and the import thread
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.profiler = None
+
+    @property
+    def stack(self):
+        # Open stages of the current thread, e.g. of a background import
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    @contextmanager
+    def stage(self, name):
+        if self.tracing_memory():
+            self.update_peak()
+        entry = {'name': name, 'peak': 0}
+        self.stack.append(entry)
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start_time
+            peak = None
+            if self.tracing_memory():
+                self.update_peak()
+                peak = entry['peak']
+            self.stack.pop()
+            # Peaks of nested stages are also peaks of the enclosing stage
+            if self.stack and peak is not None:
+                self.stack[-1]['peak'] = max(self.stack[-1]['peak'], peak)
+            path = ' / '.join([stage['name'] for stage in self.stack]
+                              + [name])
+            with self.lock:
+                self.records.append({'stage': path,
+                                     'start': time.time() - elapsed,
+                                     'time': elapsed,
+                                     'peak_memory': peak})
+                self.add_to_summary(path, elapsed, peak)
+
+    def add_to_summary(self, path, elapsed, peak):
+        entry = self.summary.setdefault(path, {'stage': path, 'calls': 0,
+                                               'total': 0, 'max': 0,
+                                               'peak_memory': None})
+        entry['calls'] += 1
+        entry['total'] += elapsed
+        entry['max'] = max(entry['max'], elapsed)
+        if peak is not None:
+            entry['peak_memory'] = max(entry['peak_memory'] or 0, peak)
+
+    def update_peak(self):
+        # Adds the peak since the last update to all open stages
+        peak = tracemalloc.get_traced_memory()[1]
+        for entry in self.stack:
+            entry['peak'] = max(entry['peak'], peak)
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+
+    def tracing_memory(self):
+        # Peaks are reset process wide, so only one thread may track them
+        return (tracemalloc.is_tracing()
+                and threading.current_thread() is threading.main_thread())
+
+    def set_memory_tracing(self, on):
+        if on and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        elif not on and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def set_profiling(self, on):
+        # Statistics are kept when profiling is paused and resumed
+        if on:
+            if self.profiler is None:
+                self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        elif self.profiler is not None:
+            self.profiler.disable()
+
+    def get_summary(self):
+        """Calls, total, mean and max time and peak memory of each stage"""
+        with self.lock:
+            summary = [dict(entry, mean=entry['total'] / entry['calls'])
+                       for entry in self.summary.values()]
+        return sorted(summary, key=lambda entry: entry['stage'])
+
+    def get_profile_stats(self, lines=30):
+        if self.profiler is None:
+            return ''
+        stream = io.StringIO()
+        stats = pstats.Stats(self.profiler, stream=stream)
+        stats.sort_stats('cumulative').print_stats(lines)
+        return stream.getvalue()
+
+    def get_report(self):
+        lines = ['%-50s %6s %10s %10s %10s' % ('Stage', 'Calls', 'Total [s]',
+                                               'Max [s]', 'Peak [MB]')]
+        for entry in self.get_summary():
+            peak = entry['peak_memory']
+            lines.append('%-50s %6d %10.4f %10.4f %10s'
+                         % (entry['stage'], entry['calls'], entry['total'],
+                            entry['max'],
+                            '-' if peak is None else '%.1f' % (peak / 1e6)))
+        return '\n'.join(lines)
+
+    def save(self, file_path=None):
+        """Dumps the summary and recent records as JSON, returns the path"""
+        if file_path is None:
+            file_name = time.strftime('Session_%Y%m%d_%H%M%S.json',
+                                      time.localtime(self.start_time))
+            file_path = os.path.join(PROFILING_FOLDER, file_name)
+        with self.lock:
+            records = list(self.records)
+        report = {'start': self.start_time, 'records': records,
+                  'summary': self.get_summary(),
+                  'profile': self.get_profile_stats()}
+        with open(file_path, 'w') as report_file:
+            json.dump(report, report_file, indent=4)
+        return file_path
+
+
+session_profile = SessionProfile()
+
+
+def profile_stage(name):
+    return session_profile.stage(name)
@@ -0,0 +1,296 @@
+"""Headless analysis of a run folder, without the GUI.
+
+Clusters the folder (or loads it from the cluster cache), applies the cuts
+and writes the histograms as arrays, the channel rates as CSV and the plots
+as images. Example:
+
+    python analysis.py ../Data/run_1 --cut wADC 500 4095 --phsBins 100
+
+or, for the clusters of module 1 only, '--cut Module 1 1'.
+
+Cuts and bins can also be given in a JSON config file, e.g.
+
+    {"cuts": {"wADC": [500, 4095], "ToF": [0, 1e15]}, "phsBins": 100}
+
+where command line arguments take precedence over the config file. Many
+runs are analysed in parallel processes with, e.g.
+
+    python analysis.py "../Data/*" --processes 4
+
+which also writes a summary table of all runs to the output folder.
+"""
+
+import matplotlib
+matplotlib.use('Agg')
+
+import os
+import glob
+import json
+import time
+import argparse
+import multiprocessing
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+
+from Plotting.PHS import PHS_1D_plot, PHS_2D_plot
+from Plotting.Coincidences import (Coincidences_2D_plot,
+                                   Coincidences_Front_Top_Side_plot)
+from Plotting.Miscellaneous import (ToF_histogram, Channels_rates_plot,
+                                    get_channel_rates)
+from Plotting.HelperFunctions import (AnalysisParameters, filter_clusters,
+                                     filter_cache)
+from Plotting.Histograms import histogram_1D, histogram_2D
+from Clustering.ClusterStore import DETECTORS, WIRES, GRIDS
+from Clustering.Decoding import get_measurement_time
+from Clustering.Cache import get_clusters, get_folder_id
+from Clustering.Mapping import get_mapping_tables
+
+# =============================================================================
+# Parameters
+# =============================================================================
+
+OUTPUT_FOLDER = os.path.join(os.path.dirname(__file__), '../Results/Analysis/')
+# Columns covered by each cut, as the filters in the GUI
+CUTS = {'wADC': ['wADC_m1', 'wADC_m2'],
+        'gADC': ['gADC_m1', 'gADC_m2'],
+        'ToF': ['ToF'],
+        'wCh': ['wCh_m1'],
+        'gCh': ['gCh_m1', 'gCh_m2'],
+        'Module': ['Module']}
+BINS = {'phsBins': 50, 'tofBins': 500, 'chBins': 2000}
+# Plots saved as images
+PLOTS = {'PHS_1D': PHS_1D_plot,
+         'PHS_2D': PHS_2D_plot,
+         'ToF': ToF_histogram,
+         'Coincidences_2D': Coincidences_2D_plot,
+         'Coincidences_Front_Top_Side': Coincidences_Front_Top_Side_plot,
+         'Channels_rates': lambda parameters: Channels_rates_plot(
+                                parameters, parameters.measurement_time)[0]}
+
+
+def get_filters(cuts):
+    """Filter parameters of the cuts {name: [min, max]}, others are off"""
+    for name in cuts:
+        if name not in CUTS:
+            raise ValueError('Unknown cut: %s (valid cuts are %s)'
+                             % (name, ', '.join(CUTS)))
+    filters = {}
+    for name, columns in CUTS.items():
+        min_val, max_val = cuts.get(name, [0, 0])
+        for column in columns:
+            filters[column] = [min_val, max_val, name in cuts]
+    return filters
+
+
+def read_config(config_path):
+    if config_path is None:
+        return {}
+    with open(config_path, 'r') as config_file:
+        return json.load(config_file)
+
+
+# =============================================================================
+# Analysis
+# =============================================================================
+
+def get_histograms(parameters):
+    """PHS, ToF and coincidence histograms as arrays, keyed on their name"""
+    histograms = {}
+    ToF = parameters.Clusters_16_layers['ToF'].values
+    histograms['ToF'], histograms['ToF_edges'] = histogram_1D(
+                                                ToF, parameters.tofBins)
+    for detector in DETECTORS:
+        clusters = filter_clusters(getattr(parameters,
+                                           'Clusters_%s' % detector),
+                                   parameters)
+        counts, edges = histogram_1D(clusters['wADC_m1'].values,
+                                     parameters.phsBins, [0, 4095])
+        histograms['PHS_Wires_%s' % detector] = counts
+        counts = sum([histogram_1D(clusters[column].values,
+                                   parameters.phsBins, [0, 4095])[0]
+                      for column in ['gADC_m1', 'gADC_m2']])
+        histograms['PHS_Grids_%s' % detector] = counts
+        histograms['PHS_edges'] = edges
+        wires = WIRES[detector]
+        counts, *_ = histogram_2D(clusters['wCh_m1'].values,
+                                  clusters['gCh_max'].values, [wires, GRIDS],
+                                  [[-0.5, wires-0.5], [-0.5, GRIDS-0.5]])
+        histograms['Coincidences_%s' % detector] = counts
+    return histograms
+
+
+def analyse_folder(folder_path, cuts=None, bins=None, plots=None,
+                   output_folder=OUTPUT_FOLDER, workers=None, use_cache=True,
+                   run=None):
+    """Analyses one run folder, returns a summary of the run.
+
+    Outputs are written to 'output_folder'/<run>/: histograms.npz,
+    rates.csv and one PNG per plot in 'plots' (all plots by default). 'run'
+    is the name of the folder by default.
+    """
+    if run is None:
+        run = os.path.basename(os.path.normpath(folder_path))
+    bins = dict(BINS, **({} if bins is None else bins))
+    plots = list(PLOTS) if plots is None else plots
+    output_path = os.path.join(output_folder, run)
+    os.makedirs(output_path, exist_ok=True)
+    summary = {'run': run, 'folder': os.path.abspath(folder_path)}
+    # Import
+    start_time = time.time()
+    store, timings = get_clusters(folder_path, workers, use_cache)
+    summary['import_time'] = time.time() - start_time
+    summary['from_cache'] = not timings
+    measurement_time = get_measurement_time(folder_path)
+    parameters = AnalysisParameters(store.view('16_layers'),
+                                    store.view('20_layers'),
+                                    data_sets=run,
+                                    filters=get_filters({} if cuts is None
+                                                        else cuts),
+                                    measurement_time=measurement_time,
+                                    **bins)
+    # Histograms and rates
+    start_time = time.time()
+    np.savez(os.path.join(output_path, 'histograms.npz'),
+             **get_histograms(parameters))
+    clusters_20 = filter_clusters(parameters.Clusters_20_layers, parameters)
+    clusters_16 = filter_clusters(parameters.Clusters_16_layers, parameters)
+    if measurement_time > 0:
+        rates = get_channel_rates(clusters_20, clusters_16, measurement_time)
+        rates.to_csv(os.path.join(output_path, 'rates.csv'), index=False)
+    summary['measurement_time'] = measurement_time
+    summary['clusters'] = len(store)
+    summary['invalid_headers'] = store.get_invalid_count()
+    for detector, clusters in zip(['20_layers', '16_layers'],
+                                  [clusters_20, clusters_16]):
+        summary['clusters_%s' % detector] = len(clusters)
+        summary['rate_%s' % detector] = (len(clusters) / measurement_time
+                                         if measurement_time > 0 else np.nan)
+    summary['histogram_time'] = time.time() - start_time
+    # Plots
+    start_time = time.time()
+    for name in plots:
+        if name == 'Channels_rates' and measurement_time <= 0:
+            continue
+        fig = PLOTS[name](parameters)
+        fig.savefig(os.path.join(output_path, '%s.png' % name),
+                    bbox_inches='tight')
+        plt.close(fig)
+    summary['plot_time'] = time.time() - start_time
+    # Release the filtered clusters of this run before the next one
+    filter_cache.clear()
+    return summary
+
+
+# =============================================================================
+# Batch processing
+# =============================================================================
+
+def get_folder_paths(patterns):
+    """Run folders matching the paths or glob patterns, without duplicates"""
+    folder_paths = []
+    for pattern in patterns:
+        for folder_path in sorted(glob.glob(pattern)):
+            folder_path = os.path.normpath(folder_path)
+            if os.path.isdir(folder_path) and folder_path not in folder_paths:
+                folder_paths.append(folder_path)
+    return folder_paths
+
+
+def get_run_names(folder_paths):
+    """Output names of the runs, unique even if folder names are repeated"""
+    names = [os.path.basename(os.path.normpath(folder_path))
+             for folder_path in folder_paths]
+    # Folders of the same name, e.g. from different beam times, also get
+    # the id of their full path
+    return [name if names.count(name) == 1
+            else '%s_%s' % (name, get_folder_id(folder_path))
+            for name, folder_path in zip(names, folder_paths)]
+
+
+def analyse_run(folder_path, run, kwargs):
+    # Failed runs are reported in the summary instead of stopping the batch
+    try:
+        return analyse_folder(folder_path, run=run, **kwargs)
+    except Exception as error:
+        return {'run': run, 'folder': os.path.abspath(folder_path),
+                'error': '%s: %s' % (type(error).__name__, error)}
+
+
+def analyse_folders(folder_paths, processes=1, output_folder=OUTPUT_FOLDER,
+                    **kwargs):
+    """Analyses many run folders in a process pool, returns the summaries.
+
+    Each worker process handles a single run and is then replaced, so the
+    memory of one run is released before the next one is started. The
+    per-run summaries are also written to 'output_folder'/summary.csv.
+    """
+    kwargs['output_folder'] = output_folder
+    if kwargs.get('workers') is None:
+        # Share the cores between the processes instead of oversubscribing
+        kwargs['workers'] = max((os.cpu_count() or 1) // max(processes, 1), 1)
+    tasks = [(folder_path, run, kwargs) for folder_path, run
+             in zip(folder_paths, get_run_names(folder_paths))]
+    # Compile the mapping tables once, instead of in every worker at once
+    get_mapping_tables()
+    summaries = []
+    if processes > 1:
+        with multiprocessing.Pool(processes, maxtasksperchild=1) as pool:
+            for summary in pool.starmap(analyse_run, tasks, chunksize=1):
+                summaries.append(summary)
+    else:
+        summaries = [analyse_run(*task) for task in tasks]
+    os.makedirs(output_folder, exist_ok=True)
+    pd.DataFrame(summaries).to_csv(os.path.join(output_folder, 'summary.csv'),
+                                   index=False)
+    return summaries
+
+
+# =============================================================================
+# Command line
+# =============================================================================
+
+def get_arguments(argv=None):
+    parser = argparse.ArgumentParser(description='Headless analysis of '
+                                                 'Multi-Grid run folders.')
+    parser.add_argument('folders', nargs='+',
+                        help='Run folder(s) with .bin files, or glob patterns')
+    parser.add_argument('--config', help='JSON file with cuts and bins')
+    parser.add_argument('--cut', nargs=3, action='append', default=[],
+                        metavar=('NAME', 'MIN', 'MAX'),
+                        help='Cut on %s, may be repeated' % ', '.join(CUTS))
+    for name in BINS:
+        parser.add_argument('--%s' % name, type=int)
+    parser.add_argument('--plots', nargs='*', choices=list(PLOTS),
+                        help='Plots to save (default: all)')
+    parser.add_argument('--output', default=OUTPUT_FOLDER,
+                        help='Output folder')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='Runs analysed in parallel')
+    parser.add_argument('--workers', type=int,
+                        help='Threads used to import each run')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Do not read or write the cluster cache')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    arguments = get_arguments(argv)
+    config = read_config(arguments.config)
+    cuts = config.get('cuts', {})
+    cuts.update({name: [float(min_val), float(max_val)]
+                 for name, min_val, max_val in arguments.cut})
+    bins = {name: config[name] for name in BINS if name in config}
+    bins.update({name: getattr(arguments, name) for name in BINS
+                 if getattr(arguments, name) is not None})
+    plots = config.get('plots') if arguments.plots is None else arguments.plots
+    folder_paths = get_folder_paths(arguments.folders)
+    summaries = analyse_folders(folder_paths, arguments.processes,
+                                arguments.output, cuts=cuts, bins=bins,
+                                plots=plots, workers=arguments.workers,
+                                use_cache=not arguments.no_cache)
+    for summary in summaries:
+        print(json.dumps(summary))
+
+if __name__ == '__main__':
+    main()
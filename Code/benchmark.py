@@ -0,0 +1,281 @@
+"""Benchmarks of the clustering and analysis stages on synthetic data.
+
+Writes runs of synthetic Mux records to a temporary folder and times each
+stage, from reading the files to preparing the data of each plot. Example:
+
+    python benchmark.py --records 1000000 10000000 --files 4 --json bench.json
+
+For every stage the best time of all repeats, the throughput [records/s]
+and the peak memory allocated during the stage are reported.
+"""
+
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+
+from Clustering.Decoding import (RECORD_DTYPE, TimeStampMask, ADCMask,
+                                 WIRE_FIELDS, Header, ModuleShift,
+                                 get_bin_file_paths, get_record_map,
+                                 get_record_chunks, decode_chunk)
+from Clustering.Import import import_clusters
+from Clustering.Cache import save_clusters, load_clusters
+from Clustering.Live import LiveHistograms
+from Clustering.ClusterStore import DETECTORS, LAYERS, WIRES, GRIDS
+from Clustering.Mapping import import_delimiter_table, get_ADC_to_Ch_LUT
+from Plotting.HelperFunctions import AnalysisParameters, filter_clusters
+from Plotting.Miscellaneous import get_channel_rates
+from Plotting.PHS import get_individual_PHS
+from Plotting.Coincidences import get_voxels
+from analysis import get_histograms, get_filters
+
+# =============================================================================
+# Synthetic data
+# =============================================================================
+
+# Number of data words in the header word
+WORD_COUNT = 12
+MODULES = 2
+# Mean time between clusters [TDC channels]
+MEAN_INTERVAL = 1000
+# Fields holding collected charges, the others hold channel positions
+CHARGE_FIELDS = ['gADC_m1', 'gADC_m2', 'wADC_m1_16', 'wADC_m2_16',
+                 'wADC_m1_20', 'wADC_m2_20']
+# Cluster cache written inside the benchmark folder
+CACHE_NAME = 'benchmark_cache'
+# Cuts applied in the filter stage
+BENCHMARK_CUTS = {'wADC': [500, 4095], 'gADC': [500, 4095], 'wCh': [0, 79]}
+
+
+def get_channel_words(windows, number_records, rng):
+    # ADC values uniformly within randomly chosen delimiter windows
+    window = rng.integers(0, len(windows), number_records)
+    start = np.ceil(windows[window, 0])
+    stop = np.floor(windows[window, 1])
+    values = start + rng.random(number_records) * (stop - start)
+    return np.minimum(values, stop - 1).astype(np.uint32)
+
+
+def generate_records(number_records, delimiters, seed=0):
+    """Records with channel ADCs inside the delimiters and rising time stamps"""
+    rng = np.random.default_rng(seed)
+    records = np.zeros(number_records, dtype=RECORD_DTYPE)
+    modules = rng.integers(0, MODULES, number_records, dtype=np.uint32)
+    records['Header'] = Header | (modules << ModuleShift) | WORD_COUNT
+    for field in CHARGE_FIELDS:
+        records[field] = rng.integers(0, 4096, number_records,
+                                      dtype=np.uint32)
+    grid_windows = np.concatenate([delimiters[detector]['Grids']
+                                   for detector in DETECTORS])
+    for field in ['gChADC_m1', 'gChADC_m2']:
+        records[field] = get_channel_words(grid_windows, number_records, rng)
+    for detector, layers in LAYERS.items():
+        for m in ['m1', 'm2']:
+            records['wChADC_%s_%d' % (m, layers)] = get_channel_words(
+                       delimiters[detector]['Wires'], number_records, rng)
+    # Time stamps wrap around as the 30-bit counter does
+    times = np.cumsum(rng.exponential(MEAN_INTERVAL, number_records))
+    records['ToF'] = times.astype(np.uint64) & TimeStampMask
+    return records
+
+
+def write_synthetic_run(folder_path, number_records, files=1, seed=0):
+    """Writes 'number_records' synthetic records split over 'files' files"""
+    os.makedirs(folder_path, exist_ok=True)
+    delimiters = import_delimiter_table()
+    sizes = np.diff(np.linspace(0, number_records, files+1).astype(int))
+    for i, size in enumerate(sizes):
+        records = generate_records(size, delimiters, seed + i)
+        records.tofile(os.path.join(folder_path, 'synthetic_%03d.bin' % i))
+    return get_bin_file_paths(folder_path)
+
+
+# =============================================================================
+# Stages
+# =============================================================================
+
+def read_files(file_paths):
+    return [np.fromfile(file_path, dtype=RECORD_DTYPE)
+            for file_path in file_paths]
+
+
+def get_field_mask(field):
+    if field == 'ToF':
+        return TimeStampMask
+    elif field == 'Header':
+        return 0xFFFFFFFF
+    else:
+        return ADCMask
+
+
+def mask_fields(file_paths):
+    # Every field of all files, masked one column at a time
+    record_maps = [get_record_map(file_path) for file_path in file_paths]
+    return {field: np.concatenate([record_map[field] & get_field_mask(field)
+                                   for record_map in record_maps])
+            for field in RECORD_DTYPE.names}
+
+
+def map_channels(columns, ADC_to_Ch_LUT):
+    channels = {}
+    for detector in DETECTORS:
+        LUT = ADC_to_Ch_LUT[detector]
+        wire_field = WIRE_FIELDS[detector]['wChADC_m1']
+        channels[detector] = [LUT['Wires'][columns[wire_field]],
+                              LUT['Grids'][columns['gChADC_m1']],
+                              LUT['Grids'][columns['gChADC_m2']]]
+    return channels
+
+
+def decode_files(file_paths, ADC_to_Ch_LUT):
+    for file_path in file_paths:
+        for _, records in get_record_chunks(get_record_map(file_path)):
+            decode_chunk(records, ADC_to_Ch_LUT)
+
+
+def get_stages(folder_path, file_paths, ADC_to_Ch_LUT, state):
+    """Stages in the order they run, as (name, function) pairs.
+
+    Later stages use the results of earlier ones through 'state'.
+    """
+    cache_path = os.path.join(folder_path, CACHE_NAME)
+
+    def import_files():
+        state['store'], _ = import_clusters(file_paths, ADC_to_Ch_LUT)
+
+    def build_views():
+        store = state['store']
+        state['parameters'] = AnalysisParameters(
+                    store.view('16_layers'), store.view('20_layers'),
+                    data_sets='benchmark', filters=get_filters(BENCHMARK_CUTS))
+
+    def filter_both():
+        parameters = state['parameters']
+        state['clusters'] = {detector: filter_clusters(
+                                 getattr(parameters, 'Clusters_%s' % detector),
+                                 parameters, use_cache=False)
+                             for detector in DETECTORS}
+
+    def individual_PHS():
+        for detector in DETECTORS:
+            clusters = state['clusters'][detector]
+            get_individual_PHS(clusters, 'w', WIRES[detector], 50)
+            get_individual_PHS(clusters, 'g', GRIDS, 50)
+
+    def live_histograms():
+        LiveHistograms().accumulate_batch(state['store'].batch(),
+                                          state['parameters'])
+
+    return [('Read', lambda: read_files(file_paths)),
+            ('Masking', lambda: state.update(columns=mask_fields(file_paths))),
+            ('Channel mapping', lambda: map_channels(state.pop('columns'),
+                                                     ADC_to_Ch_LUT)),
+            ('Decode', lambda: decode_files(file_paths, ADC_to_Ch_LUT)),
+            ('Import', import_files),
+            ('Cache save', lambda: save_clusters(state['store'], cache_path,
+                                                 folder_path)),
+            ('Cache load', lambda: load_clusters(cache_path)),
+            ('DataFrame views', build_views),
+            ('Filter', filter_both),
+            ('Histograms', lambda: get_histograms(state['parameters'])),
+            ('Channel rates', lambda: get_channel_rates(
+                                  state['clusters']['20_layers'],
+                                  state['clusters']['16_layers'], 1.0)),
+            ('Individual PHS', individual_PHS),
+            ('Voxels', lambda: [get_voxels(state['clusters'][detector],
+                                           detector)
+                                for detector in DETECTORS]),
+            ('Live histograms', live_histograms)]
+
+
+def measure(function, trace_memory=True):
+    """Time [s] and peak allocated memory [bytes] of calling 'function'"""
+    if trace_memory:
+        tracemalloc.start()
+    start_time = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start_time
+    peak = 0
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return elapsed, peak
+
+
+# =============================================================================
+# Benchmark
+# =============================================================================
+
+def run_benchmark(number_records, files=1, repeats=3, trace_memory=True):
+    """Benchmarks all stages on a synthetic run, returns one row per stage"""
+    folder_path = tempfile.mkdtemp(prefix='MG_benchmark_')
+    try:
+        file_paths = write_synthetic_run(folder_path, number_records, files)
+        ADC_to_Ch_LUT = get_ADC_to_Ch_LUT()
+        results = {}
+        for repeat in range(repeats):
+            state = {}
+            shutil.rmtree(os.path.join(folder_path, CACHE_NAME),
+                          ignore_errors=True)
+            for name, function in get_stages(folder_path, file_paths,
+                                             ADC_to_Ch_LUT, state):
+                # Memory is traced once, since tracing slows down the stage
+                elapsed, peak = measure(function,
+                                        trace_memory and repeat == 0)
+                if name not in results:
+                    results[name] = {'stage': name, 'time': elapsed,
+                                     'peak_memory': peak}
+                results[name]['time'] = min(results[name]['time'], elapsed)
+    finally:
+        shutil.rmtree(folder_path, ignore_errors=True)
+    rows = list(results.values())
+    for row in rows:
+        row['records'] = number_records
+        row['records_per_s'] = number_records / max(row['time'], 1e-9)
+    return rows
+
+
+def get_report(rows):
+    lines = ['%-18s %12s %10s %16s %12s' % ('Stage', 'Records', 'Time [s]',
+                                             'Records/s', 'Peak [MB]')]
+    for row in rows:
+        lines.append('%-18s %12d %10.4f %16.0f %12.1f'
+                     % (row['stage'], row['records'], row['time'],
+                        row['records_per_s'], row['peak_memory'] / 1e6))
+    return '\n'.join(lines)
+
+
+def get_arguments(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark clustering and '
+                                                 'analysis on synthetic data.')
+    parser.add_argument('--records', type=float, nargs='+',
+                        default=[1000000], help='Records per synthetic run')
+    parser.add_argument('--files', type=int, default=4,
+                        help='Files the records are split over')
+    parser.add_argument('--repeats', type=int, default=3,
+                        help='Repeats, the best time is reported')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='Do not trace peak memory')
+    parser.add_argument('--json', help='Also write the results to this file')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    arguments = get_arguments(argv)
+    rows = []
+    for number_records in arguments.records:
+        run_rows = run_benchmark(int(number_records), arguments.files,
+                                 arguments.repeats, not arguments.no_memory)
+        print(get_report(run_rows) + '\n')
+        rows.extend(run_rows)
+    if arguments.json is not None:
+        with open(arguments.json, 'w') as json_file:
+            json.dump(rows, json_file, indent=4)
+
+
+if __name__ == '__main__':
+    main()
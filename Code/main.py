@@ -1,24 +1,63 @@
+import time
+START_TIME = time.time()
+
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from PyQt5 import uic
 import sys
 import os
-import zipfile
-import shutil
-import numpy as np
-import struct
-import pandas as pd
-import time
-from contextlib import ExitStack
+import threading
+
+# Only the profiler is imported here: the plotting and clustering modules pull
+# in pandas, matplotlib and plotly, so they are imported on first use to show
+# the window as fast as possible
+from Plotting.Profiling import session_profile, profile_stage
+
+# =============================================================================
+# Workers
+# =============================================================================
+
+class ImportWorker(QThread):
+    """Clusters a folder in the background and reports the progress"""
+    # Files done, files, records/s and estimated time left [s]
+    progress = pyqtSignal(int, int, float, float)
+    # Store, file timings, folder and import time [s]
+    imported = pyqtSignal(object, object, str, float)
+    failed = pyqtSignal(str)
+
+    def __init__(self, folder_path, parent=None):
+        super(ImportWorker, self).__init__(parent)
+        self.folder_path = folder_path
+        self.cancel_event = threading.Event()
+
+    def run(self):
+        start_time = time.time()
+
+        def report(files_done, files, records_done, records):
+            speed = records_done / max(time.time() - start_time, 1e-9)
+            eta = (records - records_done) / speed if speed > 0 else 0
+            self.progress.emit(files_done, files, speed, eta)
+
+        from Clustering.Import import ImportCancelled
+        from Clustering.Cache import get_clusters
+        try:
+            with profile_stage('Import'):
+                store, timings = get_clusters(self.folder_path,
+                                              progress=report,
+                                              cancel=self.cancel_event)
+        except ImportCancelled:
+            self.failed.emit('Import cancelled')
+            return
+        except Exception as error:
+            self.failed.emit('Import failed: %s' % error)
+            return
+        self.imported.emit(store, timings, self.folder_path,
+                           time.time() - start_time)
+
+    def cancel(self):
+        self.cancel_event.set()
 
-from Plotting.PHS import PHS_1D_plot, PHS_2D_plot, PHS_Individual_plot
-from Plotting.Coincidences import (Coincidences_2D_plot, Coincidences_3D_plot,
-                                   Coincidences_Front_Top_Side_plot)
-from Plotting.Miscellaneous import (ToF_histogram, Channels_plot, ADC_plot,
-                                    Channels_rates_plot)
-from Plotting.HelpMessage import gethelp
-from Plotting.HelperFunctions import get_ADC_to_Ch_dict, filter_clusters
 
 # =============================================================================
 # Windows
@@ -34,8 +73,12 @@ class MainWindow(QMainWindow):
         self.measurement_time = 0
         self.data_sets = ''
         self.folder_path = ''
-        self.Clusters_20_layers = pd.DataFrame()
-        self.Clusters_16_layers = pd.DataFrame()
+        self.clusters = None
+        self.live = None
+        self.import_worker = None
+        self.watch_timer = QTimer(self)
+        self.Clusters_20_layers = None
+        self.Clusters_16_layers = None
         self.show()
         self.refresh_window()
 
@@ -44,162 +87,225 @@ class MainWindow(QMainWindow):
     # =========================================================================
 
     def cluster_action(self):
-        # Declare time testing
-        opening_time = 0
-        clustering_time = 0
-        append_time = 0
+        # The button cancels the import while one is running
+        if self.import_worker is not None:
+            self.import_worker.cancel()
+            self.statusBar.showMessage('Cancelling import...')
+            return
         # Declare parameters
         folder_path = str(QFileDialog.getExistingDirectory(self,
                                                            "Select Directory",
                                                            "../Data"))
-        first_time = time.time()
-        ADC_to_Ch_dict = get_ADC_to_Ch_dict()
-        grid_di_20 = ADC_to_Ch_dict['20_layers']['Grids']
-        grid_di_16 = ADC_to_Ch_dict['16_layers']['Grids']
-        wire_di_20 = ADC_to_Ch_dict['20_layers']['Wires']
-        wire_di_16 = ADC_to_Ch_dict['16_layers']['Wires']
         if folder_path != '':
+            # Live mode follows the current data set, so stop it first
+            if self.watch_timer.isActive():
+                self.watch_action()
+            # Load clusters from cache, or decode all files in folder in
+            # parallel, chunk by chunk, without blocking the window
+            self.import_worker = ImportWorker(folder_path, self)
+            self.import_worker.progress.connect(self.import_progress)
+            self.import_worker.imported.connect(self.import_finished)
+            self.import_worker.failed.connect(self.import_failed)
+            self.import_worker.finished.connect(self.import_stopped)
+            self.cluster_button.setText('Cancel')
+            self.refresh_button.setEnabled(False)
+            self.watch_button.setEnabled(False)
+            self.statusBar.showMessage('Importing %s...' % folder_path)
+            self.import_worker.start()
+
+    def import_progress(self, files_done, files, speed, eta):
+        self.statusBar.showMessage('Importing: %d/%d files, %.0f records/s, '
+                                   'ETA %.0f [s]' % (files_done, files, speed,
+                                                     eta))
+
+    def import_finished(self, store, timings, folder_path, import_time):
+        from Clustering.Import import get_timings_report
+        from Plotting.HelperFunctions import filter_cache
+        # Hand over the new clusters at once, on the main thread
+        self.clusters = store
+        self.Clusters_16_layers = self.clusters.view('16_layers')
+        self.Clusters_20_layers = self.clusters.view('20_layers')
+        filter_cache.clear()
+        if timings:
+            print(get_timings_report(timings, import_time))
+        else:
+            print('Loaded clusters from cache: %f [s]' % import_time)
+        print(self.clusters.get_memory_report())
+        print('Clusters per module: %s, without header signature: %d'
+              % (self.clusters.get_module_counts(),
+                 self.clusters.get_invalid_count()))
+        # Add data set to list of data sets
+        self.data_sets = folder_path.rsplit('/', 1)[-1]
+        # Assign data set name
+        self.data_sets_browser.setText(self.data_sets)
+        self.folder_path = folder_path
+        self.statusBar.showMessage('Imported %d clusters in %.1f [s]'
+                                   % (len(self.clusters), import_time))
+
+    def import_failed(self, message):
+        print(message)
+        self.statusBar.showMessage(message)
+
+    def import_stopped(self):
+        self.import_worker = None
+        self.cluster_button.setText('Import')
+        self.refresh_button.setEnabled(True)
+        self.watch_button.setEnabled(True)
+
+    def closeEvent(self, event):
+        # The worker is deleted with the window, so stop it first
+        if self.import_worker is not None:
+            self.import_worker.cancel()
+            self.import_worker.wait()
+        event.accept()
+
+    def refresh_action(self):
+        # Only cluster the records which arrived since the last import
+        if self.data_sets != '':
+            from Clustering.Import import update_clusters
+            from Clustering.Mapping import get_ADC_to_Ch_LUT
+            from Plotting.HelperFunctions import filter_cache
             start_time = time.time()
-            # Iterate through all files in folder
-            file_names = [f for f in os.listdir(folder_path) if f[-4:] == '.bin']
-            file_paths = append_folder_and_files(folder_path + '/', file_names)
-            # Import all data to be clustered
-            start_time = time.time()
-            data_files = [None]*len(file_paths)
-            size = 0
-            # Import data
-            for i, file_path in enumerate(file_paths):
-                data_files[i] = np.fromfile(file_path, dtype=np.dtype('u4'))
-                size += (len(data_files[i]) // 14)
-            opening_time = (time.time() - start_time)
-            print('Importing: %f [s]' % opening_time)
-            # Declare masks
-            start_time = time.time()
-            TimeStampMask = 0x3FFFFFFF
-            ADCMask = 0x00003FFF
-            # Declare all vectors needed
-            clusters = np.array([np.zeros([size], dtype=int),   # 0, wADC_m1_16
-                                 np.zeros([size], dtype=int),   # 1, wADC_m2_16
-                                 np.zeros([size], dtype=int),   # 4, wADC_Ch_m1_16
-                                 np.zeros([size], dtype=int),   # 5, wADC_Ch_m2_16
-                                 np.zeros([size], dtype=int),   # 8, wADC_m1_20
-                                 np.zeros([size], dtype=int),   # 9, wADC_m2_20
-                                 np.zeros([size], dtype=int),   # 10, wADC_Ch_m1_20
-                                 np.zeros([size], dtype=int),   # 11, wADC_Ch_m2_20
-                                 np.zeros([size], dtype=int),   # 2, gADC_m1
-                                 np.zeros([size], dtype=int),   # 3, gADC_m2
-                                 np.zeros([size], dtype=int),   # 6, gADC_Ch_m1
-                                 np.zeros([size], dtype=int),   # 7, gADC_Ch_m2
-                                 np.zeros([size], dtype=int)])  # 12, ToF
-            start = 0
-            for i, data_file in enumerate(data_files):
-                length = len(data_file)//14
-                matrix_T = np.reshape(data_file, (length, 14))
-                matrix = np.transpose(matrix_T)
-                clusters[0:12, start:(start+length)] = matrix[1:13, :] & ADCMask
-                clusters[12, start:(start+length)] = matrix[13, :] & TimeStampMask
-                start += length
-            # Perform channel mapping
-            wCh_m1_16 = pd.DataFrame({'a': clusters[4]})['a'].map(wire_di_16).values
-            gCh_m1_16 = pd.DataFrame({'a': clusters[6]})['a'].map(grid_di_16).values
-            gCh_m2_16 = pd.DataFrame({'a': clusters[7]})['a'].map(grid_di_16).values
-            wCh_m1_20 = pd.DataFrame({'a': clusters[10]})['a'].map(wire_di_20).values
-            gCh_m1_20 = pd.DataFrame({'a': clusters[6]})['a'].map(grid_di_20).values
-            gCh_m2_20 = pd.DataFrame({'a': clusters[7]})['a'].map(grid_di_20).values
-            # Create DataFrames
-            self.Clusters_16_layers = pd.DataFrame({'wADC_m1': clusters[0],
-                                                    'wADC_m2': clusters[1],
-                                                    'wChADC_m1': clusters[4],
-                                                    'wChADC_m2': clusters[5],
-                                                    'wCh_m1': wCh_m1_16,
-                                                    'gADC_m1': clusters[2],
-                                                    'gADC_m2': clusters[3],
-                                                    'gChADC_m1': clusters[6],
-                                                    'gChADC_m2': clusters[7],
-                                                    'gCh_m1': gCh_m1_16,
-                                                    'gCh_m2': gCh_m2_16,
-                                                    'ToF': clusters[12]})
-            self.Clusters_20_layers = pd.DataFrame({'wADC_m1': clusters[8],
-                                                    'wADC_m2': clusters[9],
-                                                    'wChADC_m1': clusters[10],
-                                                    'wChADC_m2': clusters[11],
-                                                    'wCh_m1': wCh_m1_20,
-                                                    'gADC_m1': clusters[2],
-                                                    'gADC_m2': clusters[3],
-                                                    'gChADC_m1': clusters[6],
-                                                    'gChADC_m2': clusters[7],
-                                                    'gCh_m1': gCh_m1_20,
-                                                    'gCh_m2': gCh_m2_20,
-                                                    'ToF': clusters[12]})
-            clustering_time = (time.time() - start_time)
-            print('Clustering: %f [s]' % clustering_time)
-            start_time = time.time()
-            # Add data set to list of data sets
-            self.data_sets = folder_path.rsplit('/', 1)[-1]
-            # Assign data set name
-            self.data_sets_browser.setText(self.data_sets)
-            self.update()
-            self.update()
-            self.app.processEvents()
-            self.update()
+            ADC_to_Ch_LUT = get_ADC_to_Ch_LUT()
+            with profile_stage('Refresh'):
+                new_clusters = update_clusters(self.clusters,
+                                               self.folder_path,
+                                               ADC_to_Ch_LUT)
+            self.Clusters_16_layers = self.clusters.view('16_layers')
+            self.Clusters_20_layers = self.clusters.view('20_layers')
+            filter_cache.clear()
+            print('Refresh: %d new clusters, %f [s]' % (new_clusters,
+                                                        time.time()-start_time))
             self.refresh_window()
-            window_update_time = (time.time() - start_time)
-            print('Window update: %f [s]' % window_update_time)
-            #print(self.Clusters_20_layers)
-        print('Total time')
-        print((time.time() - first_time))
-        self.folder_path = folder_path
-        self.get_measurement_time()
+
+    def watch_action(self):
+        # Toggle live mode, polling the data folder for new records
+        if self.watch_timer.isActive():
+            self.watch_timer.stop()
+            self.live = None
+            self.watch_button.setText('Watch')
+            self.refresh_button.setEnabled(True)
+        elif self.data_sets != '':
+            from Clustering.Live import LiveHistograms, WATCH_INTERVAL
+            from Plotting.HelperFunctions import get_parameters
+            self.live = LiveHistograms()
+            self.live.accumulate_batch(self.clusters.batch(),
+                                       get_parameters(self))
+            self.watch_timer.start(WATCH_INTERVAL)
+            self.watch_button.setText('Stop watching')
+            # Watch already refreshes, through the live histograms
+            self.refresh_button.setEnabled(False)
+
+    def watch_update(self):
+        import matplotlib.pyplot as plt
+        from Clustering.Import import update_clusters
+        from Clustering.Mapping import get_ADC_to_Ch_LUT
+        from Plotting.HelperFunctions import filter_cache, get_parameters
+        from Plotting.PHS import PHS_1D_plot
+        from Plotting.Miscellaneous import ToF_histogram
+        from Plotting.Coincidences import Coincidences_2D_plot
+        ADC_to_Ch_LUT = get_ADC_to_Ch_LUT()
+        parameters = get_parameters(self)
+        with profile_stage('Watch update'):
+            new_clusters = update_clusters(self.clusters, self.folder_path,
+                                           ADC_to_Ch_LUT,
+                                           callback=lambda batch:
+                                           self.live.accumulate_batch(
+                                               batch, parameters))
+        if new_clusters > 0:
+            self.Clusters_16_layers = self.clusters.view('16_layers')
+            self.Clusters_20_layers = self.clusters.view('20_layers')
+            filter_cache.clear()
+            # Redraw the live views which are still open
+            live_views = [('Live PHS (1D)', PHS_1D_plot),
+                          ('Live ToF', ToF_histogram),
+                          ('Live coincidences (2D)', Coincidences_2D_plot)]
+            for label, plot in live_views:
+                if plt.fignum_exists(label):
+                    with profile_stage(label):
+                        fig = plot(get_parameters(self), self.live)
+                        fig.canvas.draw_idle()
 
     # =========================================================================
     # Plotting
     # =========================================================================
 
+    def plot_action(self, name, plot, *args):
+        # Prepares and draws a figure, timing both as stages of the action
+        from Plotting.HelperFunctions import get_parameters
+        with profile_stage(name):
+            fig = plot(get_parameters(self), *args)
+            with profile_stage('Render'):
+                fig.canvas.draw()
+                fig.show()
+        return fig
+
     def PHS_1D_action(self):
         if self.data_sets != '':
-            fig = PHS_1D_plot(self)
-            fig.show()
+            from Plotting.PHS import PHS_1D_plot
+            self.plot_action('PHS (1D)', PHS_1D_plot, self.live)
 
     def PHS_2D_action(self):
         if self.data_sets != '':
-            fig = PHS_2D_plot(self)
-            fig.show()
+            from Plotting.PHS import PHS_2D_plot
+            self.plot_action('PHS (2D)', PHS_2D_plot)
 
     def PHS_Individual_action(self):
         if self.data_sets != '':
-            PHS_Individual_plot(self)
+            from Plotting.PHS import PHS_Individual_plot
+            from Plotting.HelperFunctions import get_parameters
+            with profile_stage('PHS (Individual)'):
+                PHS_Individual_plot(get_parameters(self))
 
     def ToF_action(self):
         if self.data_sets != '':
-            fig = ToF_histogram(self)
-            fig.show()
+            from Plotting.Miscellaneous import ToF_histogram
+            self.plot_action('ToF', ToF_histogram, self.live)
 
     def Channels_action(self):
         if self.data_sets != '':
-            fig = Channels_plot(self)
-            fig.show()
+            from Plotting.Miscellaneous import Channels_plot
+            self.plot_action('Channels', Channels_plot)
 
     def ADC_action(self):
         if self.data_sets != '':
-            fig = ADC_plot(self)
-            fig.show()
+            from Plotting.Miscellaneous import ADC_plot
+            self.plot_action('ADC', ADC_plot)
 
     def Coincidences_2D_action(self):
         if self.data_sets != '':
-            fig = Coincidences_2D_plot(self)
-            fig.show()
+            from Plotting.Coincidences import Coincidences_2D_plot
+            self.plot_action('Coincidences (2D)', Coincidences_2D_plot,
+                             self.live)
 
     def Coincidences_3D_action(self):
         if self.data_sets != '':
-            Coincidences_3D_plot(self)
+            from Plotting.Coincidences import Coincidences_3D_plot
+            from Plotting.HelperFunctions import get_parameters
+            with profile_stage('Coincidences (3D)'):
+                Coincidences_3D_plot(get_parameters(self))
 
     def Coincidences_Front_Top_Side_action(self):
         if self.data_sets != '':
-            fig = Coincidences_Front_Top_Side_plot(self)
-            fig.show()
+            from Plotting.Coincidences import Coincidences_Front_Top_Side_plot
+            self.plot_action('Coincidences (Front, Top, Side)',
+                             Coincidences_Front_Top_Side_plot)
+
+    def profile_action(self):
+        # Show the timings of this session and save them with the profile
+        report = session_profile.get_report()
+        file_path = session_profile.save()
+        print(report)
+        message_box = QMessageBox(self)
+        message_box.setWindowTitle('Session profile')
+        message_box.setText('Saved to %s' % file_path)
+        message_box.setInformativeText('<pre>%s</pre>' % report)
+        message_box.setDetailedText(session_profile.get_profile_stats())
+        message_box.show()
 
     def help_action(self):
         print("HELP!!!!")
+        from Plotting.HelpMessage import gethelp
         gethelp()
 
     def rate_action(self):
@@ -207,9 +313,12 @@ class MainWindow(QMainWindow):
             # Declare clusters
             ce_20 = self.Clusters_20_layers
             ce_16 = self.Clusters_16_layers
+            from Plotting.HelperFunctions import filter_clusters, get_parameters
             # Filter
-            ce_red_20 = filter_clusters(ce_20, self)
-            ce_red_16 = filter_clusters(ce_16, self)
+            parameters = get_parameters(self)
+            with profile_stage('Rate'):
+                ce_red_20 = filter_clusters(ce_20, parameters)
+                ce_red_16 = filter_clusters(ce_16, parameters)
             # Get measurement time
             measurement_time = self.get_measurement_time()
             rate_20 = ce_red_20.shape[0]/measurement_time
@@ -219,9 +328,20 @@ class MainWindow(QMainWindow):
 
     def channels_rates_action(self):
         if self.data_sets !='':
+            from Plotting.Miscellaneous import (Channels_rates_plot,
+                                                save_channel_rates)
+            from Plotting.HelperFunctions import get_parameters
             measurement_time = self.get_measurement_time()
-            fig = Channels_rates_plot(self, measurement_time)
-            fig.show()
+            with profile_stage('Channel rates'):
+                fig, rates = Channels_rates_plot(get_parameters(self),
+                                                 measurement_time)
+                file_name = ('%s_rates.csv'
+                             % os.path.basename(os.path.normpath(self.folder_path)))
+                print('Saved channel rates to %s'
+                      % save_channel_rates(rates, file_name))
+                with profile_stage('Render'):
+                    fig.canvas.draw()
+                    fig.show()
 
     # ========================================================================
     # Helper Functions
@@ -230,6 +350,9 @@ class MainWindow(QMainWindow):
     def setup_buttons(self):
         # File handling
         self.cluster_button.clicked.connect(self.cluster_action)
+        self.refresh_button.clicked.connect(self.refresh_action)
+        self.watch_button.clicked.connect(self.watch_action)
+        self.watch_timer.timeout.connect(self.watch_update)
         # Plotting
         self.PHS_1D_button.clicked.connect(self.PHS_1D_action)
         self.PHS_2D_button.clicked.connect(self.PHS_2D_action)
@@ -242,6 +365,10 @@ class MainWindow(QMainWindow):
         self.ADC_button.clicked.connect(self.ADC_action)
         self.rate_button.clicked.connect(self.rate_action)
         self.channels_rates_button.clicked.connect(self.channels_rates_action)
+        # Profiling
+        self.profile_button.clicked.connect(self.profile_action)
+        self.memory_checkbox.toggled.connect(session_profile.set_memory_tracing)
+        self.cProfile_checkbox.toggled.connect(session_profile.set_profiling)
         # Help
         self.help_button.clicked.connect(self.help_action)
 
@@ -255,33 +382,22 @@ class MainWindow(QMainWindow):
         self.app.processEvents()
 
     def get_measurement_time(self):
-        # Iterate through all files in folder
-        file_names = [f for f in os.listdir(self.folder_path) if f[-4:] == '.bin']
-        file_paths = append_folder_and_files(self.folder_path + '/', file_names)
-        start = os.path.getmtime(file_paths[0])
-        stop = os.path.getmtime(file_paths[-1])
-        return (stop - start)
-
+        from Clustering.Decoding import get_measurement_time
+        return get_measurement_time(self.folder_path)
 
 
 
 
-# =============================================================================
-# Helper Functions
-# =============================================================================
-
-def append_folder_and_files(folder, files):
-    folder_vec = np.array(len(files)*[folder])
-    return np.core.defchararray.add(folder_vec, files)
 
 # =============================================================================
 # Start GUI
 # =============================================================================
 
-app = QApplication(sys.argv)
-main_window = MainWindow(app)
-main_window.setAttribute(Qt.WA_DeleteOnClose, True)
-main_window.setup_buttons()
-sys.exit(app.exec_())
-
-print('I am in master')
+if __name__ == '__main__':
+    app = QApplication(sys.argv)
+    # The window is loaded from the .ui file and shown before anything else
+    main_window = MainWindow(app)
+    main_window.setAttribute(Qt.WA_DeleteOnClose, True)
+    main_window.setup_buttons()
+    print('Startup: %f [s]' % (time.time() - START_TIME))
+    sys.exit(app.exec_())